@@ -0,0 +1,161 @@
+"""Renders batches of map jobs in parallel.
+
+A job is a (plotting function, datafile, dest, options) tuple, where the plotting
+function is one of plot.py's plot_* functions (or its name) and options are its keyword
+arguments. Each worker process keeps the map engines it has built, so the basemap and
+shapefiles for a given scale/projection/resolution are only set up once per worker."""
+
+import json
+import time
+import traceback
+import multiprocessing
+
+import plot
+import util
+import instrument
+
+# Engine class, engine method and the options that go to the engine constructor, for
+# each plotting function
+engine_specs = {
+    'plot_dots': (plot.PointMap, 'dots', ('scale', 'projection', 'resolution')),
+    'plot_prop_symbols': (plot.PointMap, 'prop_symbols', ('scale', 'projection', 'resolution')),
+    'plot_density': (plot.PointMap, 'density', ('scale', 'projection', 'resolution')),
+    'plot_world_chloropleth': (plot.WorldChloropleth, 'render', ('scale', 'projection', 'resolution')),
+    'plot_us_chloropleth': (plot.USCountyChloropleth, 'render', ('scale', 'resolution')),
+    'plot_us_state_chloropleth': (plot.USStateChloropleth, 'render', ('scale', 'resolution')),
+}
+
+# Engines built by this process, by class and constructor options
+engines = {}
+
+def read_job_file(filename):
+    """Reads a JSON (or, with PyYAML installed, YAML) job file into a list of jobs.
+
+    The file holds either a list of job specs or a mapping with a 'jobs' list and
+    optional 'defaults' that apply to every job. A job spec is a mapping with 'plot' (dots,
+    prop_symbols, density, world_chloropleth, us_chloropleth or us_state_chloropleth),
+    'datafile' (a CSV or a columnar dataset; see columnar.py), 'dest' and the plotting
+    function's keyword arguments, e.g. bins, projection, resolution and scale. For
+    prop_symbols, bins is a mapping with 'thresholds' (a mapping of magnitude to
+    [size, color]) and 'default' (the [size, color] below all of them)."""
+
+    with open(filename, 'r') as fobj:
+        if filename.lower().endswith(('.yaml', '.yml')):
+            import yaml
+            spec = yaml.safe_load(fobj)
+        else:
+            spec = json.load(fobj)
+
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+    defaults = spec.get('defaults', {})
+
+    return [job_from_spec(job_spec, defaults) for job_spec in spec['jobs']]
+
+def job_from_spec(job_spec, defaults={}):
+    options = dict(defaults)
+    options.update(job_spec)
+
+    try:
+        plot_type = options.pop('plot')
+        datafile = options.pop('datafile')
+        dest = options.pop('dest')
+    except KeyError as ex:
+        raise ValueError('Job is missing %s: %r' % (ex, job_spec))
+    func = 'plot_%s' % plot_type
+    if func not in engine_specs:
+        raise ValueError('Unknown plot type: %r' % plot_type)
+
+    bins = options.get('bins')
+    if func == 'plot_prop_symbols' and isinstance(bins, dict):
+        thresholds = dict((float(mag), tuple(style)) for mag, style in bins['thresholds'].items())
+        options['bins'] = util.ColorBins(thresholds, tuple(bins['default']))
+
+    return func, datafile, dest, options
+
+def function_name(func):
+    return func if isinstance(func, str) else func.__name__
+
+def base_key(job):
+    """Identifies the engine a job renders with."""
+
+    func, datafile, dest, options = job
+    name = function_name(func)
+    if name not in engine_specs:
+        return ''
+    engine_class, method, base_options = engine_specs[name]
+    return repr((engine_class.__name__, [(o, options[o]) for o in base_options if o in options]))
+
+def get_engine(engine_class, base_options):
+    key = (engine_class, tuple(sorted(base_options.items())))
+    if key not in engines:
+        engines[key] = engine_class(**base_options)
+    return engines[key]
+
+def run_job(job):
+    """Renders one job, returning a result dict with its timings and any error."""
+
+    func, datafile, dest, options = job
+    name = function_name(func)
+    result = {'function': name, 'datafile': datafile, 'dest': dest,
+              'setup_seconds': 0.0, 'render_seconds': 0.0, 'error': None}
+
+    try:
+        if name not in engine_specs:
+            raise ValueError('Unknown plotting function: %r' % name)
+        engine_class, method, base_option_names = engine_specs[name]
+        base_options = dict((o, v) for o, v in options.items() if o in base_option_names)
+        render_options = dict((o, v) for o, v in options.items() if o not in base_option_names)
+
+        start = time.perf_counter()
+        engine = get_engine(engine_class, base_options)
+        setup_done = time.perf_counter()
+        result['setup_seconds'] = setup_done - start
+
+        getattr(engine, method)(datafile, dest, **render_options)
+        result['render_seconds'] = time.perf_counter() - setup_done
+    except Exception:
+        result['error'] = traceback.format_exc()
+
+    return result
+
+def run_indexed_job(indexed_job):
+    i, job = indexed_job
+    result = run_job(job)
+    if instrument.enabled:
+        result['metrics'] = instrument.collect()
+    return i, result
+
+def init_worker(instrumented=False, backend='Agg'):
+    if instrumented:
+        instrument.enable()
+    plot.init(backend=backend)
+
+def render_parallel(jobs, processes=None, backend='Agg'):
+    """Renders jobs over a pool of processes (by default one per core), returning their
+    results in job order. With processes=1, jobs are rendered in this process. Either way
+    they are rendered with the matplotlib backend backend.
+
+    Jobs are grouped by the engine they need, so that workers reuse their engines."""
+
+    jobs = list(jobs)
+    order = sorted(range(len(jobs)), key=lambda i: base_key(jobs[i]))
+    indexed_jobs = [(i, jobs[i]) for i in order]
+
+    results = [None] * len(jobs)
+    if processes == 1:
+        init_worker(backend=backend)
+        for i, job in indexed_jobs:
+            results[i] = run_job(job)
+        return results
+
+    processes = processes or multiprocessing.cpu_count()
+    chunksize = max(1, len(jobs) // (processes * 4))
+    with multiprocessing.Pool(processes, initializer=init_worker,
+                              initargs=(instrument.enabled, backend)) as pool:
+        for i, result in pool.imap_unordered(run_indexed_job, indexed_jobs, chunksize):
+            if 'metrics' in result:
+                instrument.merge(result.pop('metrics'))
+            results[i] = result
+
+    return results
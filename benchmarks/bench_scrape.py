@@ -0,0 +1,74 @@
+"""Compares full and strained parsing of saved Wikipedia pages.
+
+Usage: python -m benchmarks.bench_scrape [-n REPEAT] PAGE.html [PAGE.html ...]
+
+Article pages are scraped for coordinates with the default path; pages with sortable
+tables are also parsed as list pages. Results of both parses are checked to match."""
+
+import argparse
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+import scrape_coordinates
+
+def measure(func, repeat):
+    """Returns (mean seconds, peak traced bytes, result) of calling func repeat times."""
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        result = func()
+    elapsed = (time.perf_counter() - start) / repeat
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed, peak, result
+
+def bench_page(filename, repeat, path=None):
+    with open(filename, 'rb') as fobj:
+        html = fobj.read()
+
+    def full_article():
+        return scrape_coordinates.scrape_wikipedia_element(BeautifulSoup(html, 'lxml'), path)
+
+    def strained_article():
+        soup = BeautifulSoup(html, 'lxml', parse_only=scrape_coordinates.path_strainer(path))
+        return scrape_coordinates.scrape_wikipedia_element(soup, path)
+
+    def full_tables():
+        return len(BeautifulSoup(html, 'lxml').find_all('table', class_='sortable'))
+
+    def strained_tables():
+        soup = BeautifulSoup(html, 'lxml', parse_only=scrape_coordinates.table_strainer)
+        return len(soup.find_all('table', class_='sortable'))
+
+    results = []
+    for label, full, strained in [('article', full_article, strained_article),
+                                  ('tables', full_tables, strained_tables)]:
+        full_time, full_peak, full_result = measure(full, repeat)
+        strained_time, strained_peak, strained_result = measure(strained, repeat)
+        if full_result != strained_result:
+            raise AssertionError('%s: %s results differ: %r != %r' % (filename, label, full_result,
+                                                                      strained_result))
+        results.append((label, full_time, strained_time, full_peak, strained_peak))
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pages', nargs='+')
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print('page\tkind\tfull_ms\tstrained_ms\tfull_peak_kb\tstrained_peak_kb')
+    for filename in args.pages:
+        for label, full_time, strained_time, full_peak, strained_peak in bench_page(filename, args.repeat):
+            print('%s\t%s\t%.1f\t%.1f\t%d\t%d' % (filename, label, full_time * 1000, strained_time * 1000,
+                                                  full_peak // 1024, strained_peak // 1024))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Measures interpreter startup and import time of the project's modules.
+
+Usage: python -m benchmarks.bench_startup [-n REPEAT] [--top N]
+
+For each module, reports the wall time of a fresh interpreter importing it, the
+cumulative import time reported by -X importtime, and the slowest modules it imports.
+plot is also measured with plot.init(), which imports the plotting libraries."""
+
+import sys
+import time
+import argparse
+import subprocess
+
+statements = [('util', 'import util'),
+              ('pagecache', 'import pagecache'),
+              ('scrape_coordinates', 'import scrape_coordinates'),
+              ('plot', 'import plot'),
+              ('plot.init()', 'import plot; plot.init()')]
+
+def wall_time(statement, repeat):
+    """Best wall time over repeat runs of a fresh interpreter executing statement."""
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check=True)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def import_times(statement):
+    """Returns (cumulative microseconds, module) pairs from -X importtime, slowest first."""
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                          check=True, stderr=subprocess.PIPE, universal_newlines=True)
+    times = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        # Nested imports are indented past the single space after the separator
+        times.append((int(cumulative_us), module[1:].rstrip()))
+
+    return sorted(times, reverse=True)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5)
+    args = parser.parse_args()
+
+    baseline = wall_time('pass', args.repeat)
+    print('interpreter startup: %.1f ms' % (baseline * 1000))
+    for label, statement in statements:
+        elapsed = wall_time(statement, args.repeat)
+        times = import_times(statement)
+        total = sum(cumulative for cumulative, module in times if not module.startswith(' '))
+        print('%s: %.1f ms wall, %.1f ms importing' % (label, elapsed * 1000, total / 1000))
+        for cumulative, module in times[:args.top]:
+            print('    %8.1f ms  %s' % (cumulative / 1000, module.strip()))
+
+if __name__ == "__main__":
+    main()
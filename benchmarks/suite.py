@@ -0,0 +1,285 @@
+"""Benchmarks the parsing, plotting and scraping hot paths on synthetic data.
+
+Usage: python -m benchmarks.suite [-n REPEAT] [--sizes N [N ...]] [--cases CASE [CASE ...]]
+                                  [--workdir DIR] [--results FILE]
+
+Each case runs in a fresh interpreter, which reports the best and mean wall time of its
+runs and its peak RSS, both after setup (imports and inputs) and at the end. Results are
+appended to the results file as JSON lines, tagged with the git commit, and compared with
+the last earlier run of the same case and size.
+
+Inputs are generated by benchmarks.synthetic into the work directory, which the cases run
+in; the scraping cases serve the saved pages in benchmarks/fixtures over local HTTP."""
+
+import io
+import os
+import os.path
+import sys
+import json
+import time
+import argparse
+import subprocess
+import threading
+import functools
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_sizes = [1000, 100000, 1000000]
+
+chloropleth_bins = [0, 20, 40, 60, 80, 100]
+prop_symbol_bins = {5: (4, 'yellow'), 10: (6, 'orange'), 25: (8, 'red'), 50: (10, 'darkred')}
+
+# Each case takes its size and returns the function to time; size is None for cases run on
+# fixed inputs
+def parse_latlon_case(size):
+    import util
+    from benchmarks import synthetic
+    latitudes, longitudes = synthetic.coordinate_strings(size)
+    strings = list(latitudes) + list(longitudes)
+    return lambda: [util.parse_latlon(s) for s in strings]
+
+def parse_latlon_array_case(size):
+    import util
+    from benchmarks import synthetic
+    latitudes, longitudes = synthetic.coordinate_strings(size)
+    util.init()
+    return lambda: (util.parse_latlon_array(latitudes), util.parse_latlon_array(longitudes))
+
+def parse_lat_and_lon_case(size):
+    import util
+    from benchmarks import synthetic
+    pairs = synthetic.latlon_pairs(size)
+    return lambda: [util.parse_lat_and_lon(s) for s in pairs]
+
+def color_bins_case(size):
+    import util
+    from benchmarks import synthetic
+    bins = util.ColorBins(prop_symbol_bins, (2, 'gold'))
+    mags = synthetic.magnitudes(size).tolist()
+    return lambda: [bins(mag) for mag in mags]
+
+def color_bins_lookup_case(size):
+    import util
+    from benchmarks import synthetic
+    bins = util.ColorBins(prop_symbol_bins, (2, 'gold'))
+    mags = synthetic.magnitudes(size)
+    return lambda: bins.lookup(mags)
+
+def points_file(size):
+    from benchmarks import synthetic
+    return synthetic.write_points_csv('points_%d.csv' % size, size)
+
+def plot_dots_case(size):
+    import plot
+    datafile = points_file(size)
+    plot.init()
+    return lambda: plot.plot_dots(datafile, 'dots.png', scale=0.25, resolution='c')
+
+def plot_dots_columnar_case(size):
+    import plot
+    import columnar
+    datafile = 'points_%d.npy' % size
+    if not os.path.isfile(datafile):
+        columnar.convert(points_file(size), datafile)
+    plot.init()
+    return lambda: plot.plot_dots(datafile, 'dots.png', scale=0.25, resolution='c')
+
+def plot_prop_symbols_case(size):
+    import plot
+    import util
+    datafile = points_file(size)
+    plot.init()
+    bins = util.ColorBins(prop_symbol_bins, (2, 'gold'))
+    return lambda: plot.plot_prop_symbols(datafile, 'prop_symbols.png', bins, scale=0.25,
+                                          sumatsamecoords=True, resolution='c')
+
+def chloropleth_fixtures():
+    from benchmarks import synthetic
+    if not os.path.isfile('counties.csv'):
+        synthetic.write_shapefiles('.')
+        synthetic.write_chloropleth_csvs('.')
+
+def plot_world_chloropleth_case(size):
+    import plot
+    chloropleth_fixtures()
+    plot.init()
+    return lambda: plot.plot_world_chloropleth('countries.csv', 'world.png', 'viridis',
+                                               chloropleth_bins, scale=0.25, resolution='c')
+
+def plot_us_chloropleth_case(size):
+    import plot
+    chloropleth_fixtures()
+    plot.init()
+    return lambda: plot.plot_us_chloropleth('counties.csv', 'counties.png', 'viridis',
+                                            chloropleth_bins, scale=0.25, resolution='c')
+
+def plot_us_state_chloropleth_case(size):
+    import plot
+    chloropleth_fixtures()
+    plot.init()
+    return lambda: plot.plot_us_state_chloropleth('states.csv', 'states.png', 'viridis',
+                                                  chloropleth_bins, scale=0.25, resolution='c')
+
+list_page = 'wiki/List_of_events'
+
+def parse_table_headers_case(size):
+    from bs4 import BeautifulSoup
+    import scrape_coordinates
+    from benchmarks import synthetic
+    with open(os.path.join(synthetic.fixture_dir, list_page), 'rb') as fobj:
+        html = fobj.read()
+
+    def run():
+        soup = BeautifulSoup(html, 'lxml', parse_only=scrape_coordinates.table_strainer)
+        return scrape_coordinates.parse_table_headers(soup.find('table', class_='sortable'))
+    return run
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+def serve_fixtures():
+    """Serves benchmarks/fixtures on a local port in a background thread, returning its URL."""
+
+    from benchmarks import synthetic
+    handler = functools.partial(QuietHandler, directory=synthetic.fixture_dir)
+    server = HTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return 'http://127.0.0.1:%d' % server.server_port
+
+def scrape_table_case(size):
+    import scrape_coordinates
+    base_url = serve_fixtures()
+    scrape_coordinates.wikipedia_base_url = base_url
+    scrape_coordinates.set_rate_limit(0)
+    scrape_coordinates.configure_cache(None)
+
+    def run():
+        out = io.StringIO()
+        scrape_coordinates.scrape_wikipedia_table_url('%s/%s' % (base_url, list_page),
+                                                      magnitude_column='Details Deaths',
+                                                      location_column='Details Location',
+                                                      name_column='Name', out=out)
+        return out.getvalue()
+    return run
+
+# Name -> (case, whether it is run at each size)
+cases = {
+    'parse_latlon': (parse_latlon_case, True),
+    'parse_latlon_array': (parse_latlon_array_case, True),
+    'parse_lat_and_lon': (parse_lat_and_lon_case, True),
+    'color_bins': (color_bins_case, True),
+    'color_bins_lookup': (color_bins_lookup_case, True),
+    'plot_dots': (plot_dots_case, True),
+    'plot_dots_columnar': (plot_dots_columnar_case, True),
+    'plot_prop_symbols': (plot_prop_symbols_case, True),
+    'plot_world_chloropleth': (plot_world_chloropleth_case, False),
+    'plot_us_chloropleth': (plot_us_chloropleth_case, False),
+    'plot_us_state_chloropleth': (plot_us_state_chloropleth_case, False),
+    'parse_table_headers': (parse_table_headers_case, False),
+    'scrape_table': (scrape_table_case, False),
+}
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_case(name, size, repeat, workdir):
+    """Runs one case in this process, returning its measurements."""
+
+    sys.path.insert(0, repo_dir)
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    case, sized = cases[name]
+    func = case(size)
+    setup_rss = peak_rss_kb()
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return {'seconds': min(times), 'mean_seconds': sum(times) / len(times),
+            'setup_peak_rss_kb': setup_rss, 'peak_rss_kb': peak_rss_kb()}
+
+def git_commit():
+    try:
+        proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, check=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True)
+        return proc.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def previous_results(filename):
+    """Returns the latest recorded result of each (case, size) in filename."""
+
+    previous = {}
+    if os.path.isfile(filename):
+        with open(filename, 'r') as fobj:
+            for line in fobj:
+                if line.strip():
+                    result = json.loads(line)
+                    previous[(result['case'], result['size'])] = result
+    return previous
+
+def format_result(result, previous):
+    line = '%-28s %9s %10.4f s %10s KB' % (result['case'], result['size'] or '-',
+                                           result['seconds'], result['peak_rss_kb'])
+    if previous is not None:
+        line += '  (%+.1f%% time, %+d KB vs %s)' % (
+            (result['seconds'] / previous['seconds'] - 1) * 100,
+            result['peak_rss_kb'] - previous['peak_rss_kb'], previous['commit'])
+    return line
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--repeat', type=int, default=3)
+    parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes)
+    parser.add_argument('--cases', nargs='+', choices=sorted(cases), default=list(cases))
+    parser.add_argument('--workdir', default=os.path.join(repo_dir, 'benchmarks', 'work'))
+    parser.add_argument('--results', default=os.path.join(repo_dir, 'benchmarks', 'results.jsonl'))
+    # Internal: run a single case in this process and print its measurements
+    parser.add_argument('--run', nargs=2, metavar=('CASE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    workdir = os.path.abspath(args.workdir)
+
+    if args.run:
+        name, size = args.run
+        size = int(size) if size != '-' else None
+        print(json.dumps(run_case(name, size, args.repeat, workdir)))
+        return
+
+    previous = previous_results(args.results)
+    commit = git_commit()
+    timestamp = time.strftime('%Y-%m-%dT%H:%M:%S')
+
+    with open(args.results, 'a') as fobj:
+        for name in args.cases:
+            case, sized = cases[name]
+            for size in (args.sizes if sized else [None]):
+                proc = subprocess.run([sys.executable, '-m', 'benchmarks.suite', '-n', str(args.repeat),
+                                       '--workdir', workdir, '--run', name, str(size or '-')],
+                                      cwd=repo_dir, stdout=subprocess.PIPE, universal_newlines=True)
+                if proc.returncode != 0:
+                    print('%-28s %9s failed' % (name, size or '-'))
+                    continue
+
+                result = {'case': name, 'size': size, 'repeat': args.repeat, 'commit': commit,
+                          'timestamp': timestamp, 'python': sys.version.split()[0]}
+                result.update(json.loads(proc.stdout.splitlines()[-1]))
+                print(format_result(result, previous.get((name, size))))
+                fobj.write(json.dumps(result, sort_keys=True) + '\n')
+                fobj.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""Generates the synthetic inputs for the benchmark suite.
+
+Everything is seeded, so a given size always produces the same data. Coordinates are
+a mix of decimal degrees and the degree/minute/second forms util.parse_latlon accepts.
+Shapefiles are small grids of squares written with pyshp under the names plot.py
+expects, along with a matching data/Census.csv."""
+
+import os
+import os.path
+import csv
+
+import numpy as np
+import pandas as pd
+import shapefile
+
+fixture_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Fraction of coordinates written as decimal degrees, D.DDD°N and D°M′S″N respectively
+coordinate_mix = (0.7, 0.15, 0.15)
+
+def format_dms(values, positive, negative, rng):
+    """Formats an array of signed degrees as a mix of decimal and DMS strings."""
+
+    kinds = rng.choice(3, size=len(values), p=coordinate_mix)
+    hemispheres = np.where(values >= 0, positive, negative)
+    magnitudes = np.abs(values)
+
+    strings = np.round(values, 5).astype(str).astype(object)
+    for i in np.flatnonzero(kinds == 1):
+        strings[i] = '%.4f°%s' % (magnitudes[i], hemispheres[i])
+    for i in np.flatnonzero(kinds == 2):
+        degrees, rest = divmod(magnitudes[i] * 3600, 3600)
+        minutes, seconds = divmod(rest, 60)
+        strings[i] = '%d°%d′%d″%s' % (degrees, minutes, seconds, hemispheres[i])
+
+    return strings
+
+def coordinate_strings(rows, seed=0):
+    """Returns (latitudes, longitudes) arrays of mixed-format coordinate strings."""
+
+    rng = np.random.RandomState(seed)
+    latitudes = rng.uniform(-70, 70, rows)
+    longitudes = rng.uniform(-180, 180, rows)
+    return format_dms(latitudes, 'N', 'S', rng), format_dms(longitudes, 'E', 'W', rng)
+
+def latlon_pairs(rows, seed=0):
+    """Returns 'lat, lon' strings in the forms util.parse_lat_and_lon accepts."""
+
+    latitudes, longitudes = coordinate_strings(rows, seed)
+    separators = np.random.RandomState(seed + 1).choice([', ', ' ', ','], size=rows)
+    pairs = []
+    for lat, lon, sep in zip(latitudes, longitudes, separators):
+        # Only a northern latitude followed by an unsigned longitude can go without a comma
+        if sep == ' ' and not (lat.endswith('N') and lon[0].isdigit()):
+            sep = ', '
+        pairs.append('%s%s%s' % (lat, sep, lon))
+    return pairs
+
+def magnitudes(rows, seed=0):
+    return np.random.RandomState(seed + 2).lognormal(2, 1, rows).round(2)
+
+def write_points_csv(filename, rows, seed=0):
+    """Writes a CSV of points with mixed-format coordinates and magnitudes. Coordinates
+    repeat (one distinct location per ten rows) so there is something to sum."""
+
+    if os.path.exists(filename):
+        return filename
+
+    distinct = max(rows // 10, 1)
+    latitudes, longitudes = coordinate_strings(distinct, seed)
+    picks = np.random.RandomState(seed + 3).randint(0, distinct, rows)
+    df = pd.DataFrame({'Latitude': latitudes[picks], 'Longitude': longitudes[picks],
+                       'Magnitude': magnitudes(rows, seed)})
+    df.to_csv(filename, index=False)
+    return filename
+
+def square(x, y, size):
+    return [[(x, y), (x, y + size), (x + size, y + size), (x + size, y), (x, y)]]
+
+def write_shapefiles(workdir):
+    """Writes the world, US county and US state fixture shapefiles and data/Census.csv,
+    returning the number of counties."""
+
+    world = os.path.join(workdir, 'ne_10m_admin_0_countries_lakes', 'ne_10m_admin_0_countries_lakes')
+    counties = os.path.join(workdir, 'cb_2017_us_county_500k', 'cb_2017_us_county_500k')
+    states = os.path.join(workdir, 'cb_2017_us_state_500k', 'cb_2017_us_state_500k')
+    census = os.path.join(workdir, 'data', 'Census.csv')
+    for filename in (world, counties, states, census):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+    # A 5 degree grid of countries, with three letter codes
+    writer = shapefile.Writer(world, shapeType=shapefile.POLYGON)
+    writer.field('ADM0_A3', 'C')
+    i = 0
+    for x in range(-180, 180, 5):
+        for y in range(-60, 75, 5):
+            writer.poly(square(x, y, 5))
+            writer.record(country_code(i))
+            i += 1
+    writer.close()
+
+    # A 0.5 degree grid of counties over the contiguous US, plus Alaska and Hawaii
+    writer = shapefile.Writer(counties, shapeType=shapefile.POLYGON)
+    writer.field('GEOID', 'C')
+    num_counties = 0
+    with open(census, 'w', newline='') as fobj:
+        census_writer = csv.writer(fobj)
+        census_writer.writerow(['Geography', 'Geoid'])
+        for x, y, size in county_grid():
+            num_counties += 1
+            state = num_counties % 50 + 1
+            geoid = state * 1000 + num_counties
+            writer.poly(square(x, y, size))
+            writer.record('%05d' % geoid)
+            census_writer.writerow(['County %d County, State %d' % (num_counties, state), geoid])
+    writer.close()
+
+    writer = shapefile.Writer(states, shapeType=shapefile.POLYGON)
+    writer.field('AFFGEOID', 'C')
+    for state in range(1, 51):
+        writer.poly(square(-125 + state, 30, 1))
+        writer.record('0400000US%02d' % state)
+    writer.close()
+
+    return num_counties
+
+def county_grid():
+    for x in np.arange(-120, -70, 0.5):
+        for y in np.arange(26, 46, 0.5):
+            yield x, y, 0.5
+    for x in np.arange(-165, -145, 2):
+        for y in np.arange(58, 68, 2):
+            yield x, y, 2
+    for x in np.arange(-160, -155, 1):
+        yield x, 19.5, 1
+
+def country_code(i):
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return letters[i // 676 % 26] + letters[i // 26 % 26] + letters[i % 26]
+
+def write_chloropleth_csvs(workdir, seed=0):
+    """Writes the country, county and state data CSVs for the fixture shapefiles."""
+
+    rng = np.random.RandomState(seed + 4)
+
+    counties = pd.read_csv(os.path.join(workdir, 'data', 'Census.csv'))
+    counties['Magnitude'] = rng.uniform(0, 100, len(counties)).round(1)
+    counties[['Geography', 'Magnitude']].to_csv(os.path.join(workdir, 'counties.csv'), index=False)
+
+    num_countries = len(range(-180, 180, 5)) * len(range(-60, 75, 5))
+    countries = pd.DataFrame({'Country Name': ['Country %d' % i for i in range(num_countries)],
+                              'Country Code': [country_code(i) for i in range(num_countries)],
+                              'Magnitude': rng.uniform(0, 100, num_countries).round(1)})
+    countries.to_csv(os.path.join(workdir, 'countries.csv'), index=False)
+
+    states = pd.DataFrame({'Geography': ['State %d' % i for i in range(1, 51)],
+                           'AFFGEOID': ['0400000US%02d' % i for i in range(1, 51)],
+                           'Magnitude': rng.uniform(0, 100, 50).round(1)})
+    states.to_csv(os.path.join(workdir, 'states.csv'), index=False)
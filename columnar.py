@@ -0,0 +1,104 @@
+"""Binary columnar datasets, which load without parsing any text.
+
+A dataset is either a NumPy structured array saved as .npy, which is memory-mapped, or a
+Feather (Arrow IPC) file, which is memory-mapped through pyarrow if it is installed.
+Either way pages are read from disk as they are used, and shared between processes
+reading the same file.
+
+A .npy dataset is stored row by row, so its columns are interleaved on disk: reading only
+'Latitude' and 'Longitude' still pages in the bytes of every column, and the I/O is that
+of the whole file. Only Feather files are laid out column by column, so that reading a
+few columns of a wide dataset reads just those.
+
+convert turns a CSV into a dataset once, parsing its 'Latitude' and 'Longitude' columns
+(in any format util.parse_latlon accepts) into float64.
+
+Usage: python columnar.py [--sep SEP] CSVFILE DEST.npy|DEST.feather"""
+
+import os.path
+import argparse
+
+import util
+import instrument
+from util import LazyModule
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+feather = LazyModule('pyarrow.feather')
+
+extensions = ('.npy', '.feather', '.arrow')
+
+def is_columnar(datafile):
+    return isinstance(datafile, str) and datafile.lower().endswith(extensions)
+
+def read_columns(datafile, usecols=None):
+    """Returns the columns usecols (by default all) of a dataset as a DataFrame, backed by
+    the memory-mapped file where possible. For .npy datasets the columns are strided views
+    of the rows, so pages holding the other columns are read too."""
+
+    with instrument.span('plot.read_columns'):
+        if datafile.lower().endswith('.npy'):
+            records = np.load(datafile, mmap_mode='r')
+            if records.dtype.names is None:
+                raise ValueError('%s is not a structured array' % datafile)
+            missing = set(usecols or ()) - set(records.dtype.names)
+            if missing:
+                raise ValueError('Columns missing from %s: %s' % (datafile, ', '.join(sorted(missing))))
+            return pd.DataFrame(dict((name, records[name]) for name in usecols or records.dtype.names),
+                                copy=False)
+        else:
+            table = feather.read_table(datafile, columns=usecols, memory_map=True)
+            return table.to_pandas(split_blocks=True)
+
+def to_records(df):
+    """Converts df to a structured array, with text columns as fixed-width strings. The
+    array is row-major: each record holds one value of every column."""
+
+    columns = []
+    for name in df.columns:
+        values = df[name].to_numpy()
+        if values.dtype.kind not in 'biufcmM':
+            values = values.astype(str)
+        columns.append((str(name), values))
+
+    records = np.empty(len(df), dtype=[(name, values.dtype) for name, values in columns])
+    for name, values in columns:
+        records[name] = values
+    return records
+
+def convert(csvfile, dest, inputkwargs={}):
+    """Converts a CSV to a dataset at dest (.npy or .feather), parsing its 'Latitude' and
+    'Longitude' columns, if it has them, and dropping rows where they cannot be parsed.
+    Returns the number of rows written."""
+
+    df = pd.read_csv(csvfile, dtype={'Latitude': str, 'Longitude': str}, **inputkwargs)
+    coords = [col for col in ('Latitude', 'Longitude') if col in df]
+    for col in coords:
+        df[col] = util.parse_latlon_array(df[col])
+    if coords:
+        df = df.dropna(subset=coords)
+
+    if dest.lower().endswith('.npy'):
+        tmp_dest = '%s.tmp%d.npy' % (dest[:-len('.npy')], os.getpid())
+        np.save(tmp_dest, to_records(df))
+    elif dest.lower().endswith(extensions):
+        tmp_dest = '%s.tmp%d' % (dest, os.getpid())
+        feather.write_feather(df.reset_index(drop=True), tmp_dest)
+    else:
+        raise ValueError('Unknown dataset format: %r' % dest)
+    os.replace(tmp_dest, dest)
+
+    return len(df)
+
+def main():
+    parser = argparse.ArgumentParser(description='Converts a CSV to a binary columnar dataset.')
+    parser.add_argument('csvfile')
+    parser.add_argument('dest', help='Output file, .npy or .feather')
+    parser.add_argument('--sep', default=',', help='CSV field separator')
+    args = parser.parse_args()
+
+    rows = convert(args.csvfile, args.dest, {'sep': args.sep})
+    print('Wrote %d rows to %s' % (rows, args.dest))
+
+if __name__ == "__main__":
+    main()
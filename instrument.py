@@ -0,0 +1,120 @@
+"""Lightweight run instrumentation: named timing spans, counters and peak memory.
+
+Disabled by default, in which case span() returns a shared no-op context manager and
+count() returns immediately. Enable it with enable(), then write_report() the results
+as JSON at the end of the run."""
+
+import json
+import time
+import threading
+from collections import defaultdict
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+enabled = False
+
+lock = threading.Lock()
+# Name -> [number of times entered, total seconds]
+spans = defaultdict(lambda: [0, 0.0])
+counters = defaultdict(int)
+# Largest peak RSS reported by worker processes through merge
+worker_peak_rss = {'kb': None}
+
+class NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+null_span = NullSpan()
+
+class Span(object):
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        with lock:
+            stats = spans[self.name]
+            stats[0] += 1
+            stats[1] += elapsed
+        return False
+
+def span(name):
+    """Context manager timing the code it wraps under name."""
+
+    if not enabled:
+        return null_span
+    return Span(name)
+
+def count(name, n=1):
+    if not enabled:
+        return
+    with lock:
+        counters[name] += n
+
+def enable():
+    global enabled
+    reset()
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with lock:
+        spans.clear()
+        counters.clear()
+        worker_peak_rss['kb'] = None
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def report():
+    """Returns the spans, counters and peak memory recorded so far as a JSON-able dict."""
+
+    with lock:
+        return {'spans': dict((name, {'count': n, 'seconds': seconds})
+                              for name, (n, seconds) in sorted(spans.items())),
+                'counters': dict(sorted(counters.items())),
+                'peak_rss_kb': peak_rss_kb(),
+                'worker_peak_rss_kb': worker_peak_rss['kb']}
+
+def collect():
+    """Returns report() and resets, for handing results from a worker to its parent."""
+
+    result = report()
+    reset()
+    return result
+
+def merge(other):
+    """Adds the spans and counters of a report from another process to this one."""
+
+    with lock:
+        for name, stats in other['spans'].items():
+            spans[name][0] += stats['count']
+            spans[name][1] += stats['seconds']
+        for name, n in other['counters'].items():
+            counters[name] += n
+        peak = other['peak_rss_kb']
+        if peak is not None and (worker_peak_rss['kb'] is None or peak > worker_peak_rss['kb']):
+            worker_peak_rss['kb'] = peak
+
+def write_report(filename, **extra):
+    """Writes report(), plus any extra fields, to filename as JSON."""
+
+    result = report()
+    result.update(extra)
+    with open(filename, 'w') as fobj:
+        json.dump(result, fobj, indent=2, sort_keys=True)
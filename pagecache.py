@@ -0,0 +1,159 @@
+import os
+import io
+import time
+import sqlite3
+import threading
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+import instrument
+
+class PageCache(object):
+    """Persistent SQLite cache of fetched pages.
+
+    Fresh pages (fetched less than ttl seconds ago) are served without touching the
+    network; stale ones are revalidated with If-None-Match/If-Modified-Since. Once the
+    cached bodies exceed max_size bytes, the least recently used pages are evicted. In
+    offline mode only cached pages are served, stale or not, and misses raise an
+    HTTPError with status 504 (as for an only-if-cached request).
+
+    fetch is called with a urllib Request to go to the network."""
+
+    def __init__(self, path, ttl=7 * 24 * 60 * 60, max_size=512 * 1024 * 1024, offline=False,
+                 fetch=urlopen):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self.fetch = fetch
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS pages '
+                              '(url TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT, '
+                              'fetched REAL, accessed REAL, size INTEGER)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS pages_accessed ON pages (accessed)')
+
+    def lookup(self, url):
+        with self.lock:
+            return self.conn.execute('SELECT body, etag, last_modified, fetched FROM pages WHERE url = ?',
+                                     (url,)).fetchone()
+
+    def touch(self, url, fetched=None):
+        now = time.time()
+        with self.lock, self.conn:
+            if fetched is None:
+                self.conn.execute('UPDATE pages SET accessed = ? WHERE url = ?', (now, url))
+            else:
+                self.conn.execute('UPDATE pages SET accessed = ?, fetched = ? WHERE url = ?',
+                                  (now, fetched, url))
+
+    def store(self, url, body, etag, last_modified):
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (url, body, etag, last_modified, now, now, len(body)))
+            self._evict()
+
+    def _evict(self):
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        for url, size in self.conn.execute('SELECT url, size FROM pages ORDER BY accessed').fetchall():
+            self.conn.execute('DELETE FROM pages WHERE url = ?', (url,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+    def open(self, url):
+        """Returns a file object with the body of url, from the cache if possible."""
+
+        cached = self.lookup(url)
+        if cached is not None:
+            body, etag, last_modified, fetched = cached
+            if self.offline or time.time() - fetched < self.ttl:
+                self.touch(url)
+                instrument.count('page_cache_hits')
+                return io.BytesIO(body)
+        elif self.offline:
+            instrument.count('page_cache_misses')
+            raise HTTPError(url, 504, 'Not in cache (offline mode)', {}, None)
+
+        request = Request(url)
+        if cached is not None:
+            if etag:
+                request.add_header('If-None-Match', etag)
+            if last_modified:
+                request.add_header('If-Modified-Since', last_modified)
+
+        try:
+            with self.fetch(request) as fobj:
+                body = fobj.read()
+                headers = fobj.headers
+        except HTTPError as ex:
+            if ex.code == 304 and cached is not None:
+                self.touch(url, fetched=time.time())
+                instrument.count('page_cache_revalidated')
+                return io.BytesIO(cached[0])
+            raise
+
+        instrument.count('page_cache_misses')
+        self.store(url, body, headers.get('ETag'), headers.get('Last-Modified'))
+        return io.BytesIO(body)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __repr__(self):
+        return 'PageCache(%r, ttl=%r, max_size=%r, offline=%r)' % (self.path, self.ttl,
+                                                                   self.max_size, self.offline)
+
+class CoordinateCache(object):
+    """Persistent SQLite cache of the coordinates scraped from articles, keyed by article
+    URL and scrape path. Negative results (articles without coordinates) are cached too."""
+
+    def __init__(self, path):
+        self.path = path
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS coordinates '
+                              '(url TEXT, path TEXT, found INTEGER, lat TEXT, lon TEXT, '
+                              'PRIMARY KEY (url, path))')
+
+    def get(self, url, path_key):
+        """Returns (True, coords) on a hit, where coords may be None, or (False, None)."""
+
+        with self.lock:
+            row = self.conn.execute('SELECT found, lat, lon FROM coordinates WHERE url = ? AND path = ?',
+                                    (url, path_key)).fetchone()
+        if row is None:
+            return False, None
+
+        found, lat, lon = row
+        return True, ((lat, lon) if found else None)
+
+    def put(self, url, path_key, coords):
+        if coords is None:
+            row = (url, path_key, 0, None, None)
+        else:
+            lat, lon = coords
+            row = (url, path_key, 1, None if lat is None else str(lat), None if lon is None else str(lon))
+
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO coordinates VALUES (?, ?, ?, ?, ?)', row)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __repr__(self):
+        return 'CoordinateCache(%r)' % self.path
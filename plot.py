@@ -1,22 +1,45 @@
 import re
+import os
+import sys
+import os.path
+import pickle
 import argparse
 from operator import itemgetter
-from collections import defaultdict
 import csv
 
-import matplotlib as mpl
-from mpl_toolkits.basemap import Basemap
-# https://matplotlib.org/basemap/index.html
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gs
-import numpy as np
-import pandas as pd
-
-from geonamescache import GeonamesCache
-from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
-
 import util
+import columnar
+import shapecache
+import spatialindex
+import tiles
+import instrument
+from util import LazyModule
+
+# The plotting libraries take seconds to import, so they are only imported when first
+# used; see init
+mpl = LazyModule('matplotlib')
+basemap = LazyModule('mpl_toolkits.basemap')
+# https://matplotlib.org/basemap/index.html
+plt = LazyModule('matplotlib.pyplot')
+gs = LazyModule('matplotlib.gridspec')
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+
+geonamescache = LazyModule('geonamescache')
+mpatches = LazyModule('matplotlib.patches')
+mcollections = LazyModule('matplotlib.collections')
+mcolors = LazyModule('matplotlib.colors')
+
+def init(backend=None):
+    """Imports the plotting libraries now rather than on first use, optionally selecting
+    a matplotlib backend (e.g. 'Agg') first."""
+
+    if backend:
+        mpl.use(backend)
+    for module in (mpl, basemap, plt, gs, np, pd, geonamescache, mpatches, mcollections, mcolors):
+        module.import_now()
+    util.init()
+    shapecache.init()
 
 default_size = 40
 default_map_linewidth = 0.4
@@ -27,123 +50,530 @@ equivalencies = {2158: 2270, # Wade Hampton Census Area = Kusilvak Census Area,
                 }
 equivalencies.update(dict([(v, k) for k, v in equivalencies.items()]))
 
+scatter_style_keys = {'markeredgecolor': 'edgecolors',
+                      'markeredgewidth': 'linewidths',
+                      'markerfacecolor': 'facecolors'}
+# Keywords scatter takes itself rather than passing on to the collection
+scatter_keywords = set(['marker', 'facecolors', 'edgecolors', 'linewidths'])
+
+# Shapes are simplified to within this many output pixels of their outlines before
+# drawing (see shapecache.simplify_shapes); None draws them at full detail
+lod_pixels = 0.5
+
 geography_parse_re = re.compile(r'^(.+?)(?: (city|borough|city and borough|census area|parish|county|municipality))?, (.+)$', re.I)
 
-def plot_dots(datafile, dest, size=6, color='red', scale=1,
-              projection='robin', resolution='l', descending=False, inputkwargs={}):
-    """Format: CSV with 'Latitude' and 'Longitude' columns."""
+def read_table(datafile, inputkwargs={}):
+    """Reads a CSV, or a binary columnar dataset (see columnar.py), into a DataFrame."""
+
+    if columnar.is_columnar(datafile):
+        return columnar.read_columns(datafile)
+    with instrument.span('plot.read_csv'):
+        return pd.read_csv(datafile, **inputkwargs)
+
+def parse_coordinates(df):
+    """Parses the 'Latitude' and 'Longitude' columns of df a whole column at a time,
+    dropping rows where either could not be parsed. Columns that are already numeric
+    are left as they are."""
+
+    with instrument.span('plot.parse_coordinates'):
+        for col in ('Latitude', 'Longitude'):
+            if df[col].dtype.kind != 'f':
+                df[col] = util.parse_latlon_array(df[col])
+
+    unparsed = df['Latitude'].isna().to_numpy() | df['Longitude'].isna().to_numpy()
+    if unparsed.any():
+        df = df[~unparsed]
+    return df
+
+def read_coordinates(datafile, usecols, inputkwargs={}):
+    """Reads a CSV, parsing its 'Latitude' and 'Longitude' columns a whole column at a time.
+
+    Binary columnar datasets (see columnar.py) are memory-mapped instead, and need no
+    parsing if converted by columnar.convert."""
+
+    if columnar.is_columnar(datafile):
+        df = columnar.read_columns(datafile, usecols)
+    else:
+        with instrument.span('plot.read_csv'):
+            df = pd.read_csv(datafile, dtype={'Latitude': str, 'Longitude': str},
+                             usecols=usecols, **inputkwargs)
+
+    return parse_coordinates(df)
+
+def iter_coordinates(datafile, usecols, chunksize, inputkwargs={}):
+    """Like read_coordinates, but reads the CSV chunksize rows at a time, yielding each
+    chunk once its coordinates are parsed."""
+
+    if columnar.is_columnar(datafile):
+        df = columnar.read_columns(datafile, usecols)
+        for start in range(0, len(df), chunksize):
+            instrument.count('chunks_read')
+            yield parse_coordinates(df.iloc[start:start + chunksize])
+        return
+
+    with pd.read_csv(datafile, dtype={'Latitude': str, 'Longitude': str}, usecols=usecols,
+                     chunksize=chunksize, **inputkwargs) as reader:
+        while True:
+            with instrument.span('plot.read_csv'):
+                chunk = next(reader, None)
+            if chunk is None:
+                break
+            instrument.count('chunks_read')
+            yield parse_coordinates(chunk)
+
+def coordinate_chunks(datafile, usecols, chunksize=None, inputkwargs={}):
+    """Parsed chunks of chunksize rows of a CSV (see iter_coordinates), or with no
+    chunksize, the whole CSV as one chunk."""
+
+    if chunksize:
+        return iter_coordinates(datafile, usecols, chunksize, inputkwargs)
+    else:
+        return [read_coordinates(datafile, usecols, inputkwargs)]
+
+def scatter_style(style):
+    """Translates Line2D marker keywords (as passed to Basemap.plot) to their scatter
+    equivalents, or returns None if any has none (e.g. fillstyle or markerfacecoloralt)."""
+
+    translated = {'zorder': 2} # Match the default zorder of Line2D markers
+    for key, value in style.items():
+        if key == 'linestyle':
+            continue
+        key = scatter_style_keys.get(key, key)
+        if key not in scatter_keywords and not hasattr(mcollections.PathCollection, 'set_' + key):
+            return None
+        translated[key] = value
+
+    return translated
+
+def scatter_points(m, latitudes, longitudes, sizes, colors, style):
+    """Projects all points in one call and draws them as a single collection, which is
+    returned.
+
+    Sizes are marker diameters in points, as with Basemap.plot; points later in the
+    arrays are drawn on top."""
+
+    with instrument.span('plot.project'):
+        x, y = m(np.asarray(longitudes, dtype=np.float64), np.asarray(latitudes, dtype=np.float64))
+    instrument.count('points_plotted', len(x))
+
+    style = scatter_style(style)
+    # As with Basemap.plot, markerfacecolor overrides the fill color
+    colors = style.pop('facecolors', colors)
+    with instrument.span('plot.draw'):
+        return m.scatter(x, y, s=np.square(sizes), c=colors, **style)
+
+def savefig(fig, dest):
+    """Saves fig to dest, or as a tile pyramid if dest is a directory ending in '.tiles'
+    (see tiles.py)."""
+
+    with instrument.span('plot.savefig'):
+        if tiles.is_tiles(dest):
+            tiles.save_tiles(fig, dest)
+        else:
+            fig.savefig(dest, bbox_inches='tight')
+    instrument.count('maps_saved')
 
+def point_style(scale, custom_style={}):
     style = {'linestyle': 'none',
              'marker': 'o',
              'markeredgecolor': 'black',
              'markeredgewidth': 0.3 * scale}
+    style.update(custom_style)
 
-    plt.figure(figsize=(default_size * scale, default_size * scale))
-    m = Basemap(projection=projection, lon_0=0, resolution=resolution)
-    m.drawmapboundary(linewidth=default_map_linewidth * scale)
-    m.drawcoastlines(linewidth=default_map_linewidth * scale, color='black')
-    m.drawcountries(linewidth=default_border_linewidth * scale, color='black')
+    return style
+
+def aggregate_magnitudes(df, usecol, sumatsamecoords):
+    """Collapses the rows of df at the same coordinates into one, summing their magnitudes
+    or keeping the last one. Coordinates stay in order of first appearance."""
+
+    grouped = df.groupby(['Latitude', 'Longitude'], sort=False)[usecol]
+    if sumatsamecoords:
+        return grouped.sum().reset_index()
+    else:
+        return grouped.last().reset_index()
+
+def read_magnitudes(datafile, usecol='Magnitude', sumatsamecoords=False, descending=False,
+                    inputkwargs={}, chunksize=None, snap=None):
+    """Reads a CSV of point magnitudes, returning arrays of latitudes, longitudes and
+    magnitudes sorted by magnitude.
+
+    With chunksize, the CSV is read and aggregated that many rows at a time, so memory
+    is bounded by the number of distinct coordinates rather than the number of rows.
+    With snap, coordinates are rounded to a grid of that many degrees first, merging
+    points closer than that."""
+
+    points = None
+    for chunk in coordinate_chunks(datafile, ['Latitude', 'Longitude', usecol], chunksize,
+                                   inputkwargs):
+        with instrument.span('plot.aggregate'):
+            chunk = chunk.dropna(subset=[usecol])
+            if snap:
+                for col in ('Latitude', 'Longitude'):
+                    chunk[col] = np.round(chunk[col] / snap) * snap
+            if points is not None:
+                chunk = pd.concat([points, chunk], ignore_index=True)
+            points = aggregate_magnitudes(chunk, usecol, sumatsamecoords)
+    if points is None: # No rows at all
+        points = pd.DataFrame({'Latitude': [], 'Longitude': [], usecol: []})
+
+    magnitudes = points[usecol].to_numpy()
+    # Stable, so points with equal magnitudes stay in order of first appearance
+    order = np.argsort(-magnitudes if descending else magnitudes, kind='stable')
+    return (points['Latitude'].to_numpy()[order], points['Longitude'].to_numpy()[order],
+            magnitudes[order])
+
+def bin_points(grid, extent, x, y, weights=None):
+    """Adds the number of points (or their total weight) in each cell of grid, which
+    covers extent (xmin, xmax, ymin, ymax) in projected coordinates, to the cell.
+
+    Points outside extent, or with non-finite coordinates, are ignored."""
+
+    rows, cols = grid.shape
+    xmin, xmax, ymin, ymax = extent
+    col = np.floor((x - xmin) * (cols / (xmax - xmin)))
+    row = np.floor((y - ymin) * (rows / (ymax - ymin)))
+    inside = (col >= 0) & (col < cols) & (row >= 0) & (row < rows)
+    if weights is not None:
+        weights = weights[inside]
+
+    cells = row[inside].astype(np.intp) * cols + col[inside].astype(np.intp)
+    grid += np.bincount(cells, weights, minlength=grid.size).reshape(grid.shape)
+
+class PointMap(object):
+    """A world map with coastlines and borders, drawn once, onto which any number of
+    point layers can be rendered; each render only draws and saves its own layer."""
+
+    def __init__(self, scale=1, projection='robin', resolution='l'):
+        self.scale = scale
+
+        with instrument.span('plot.basemap'):
+            self.fig = plt.figure(figsize=(default_size * scale, default_size * scale))
+            self.ax = self.fig.gca()
+            self.m = m = basemap.Basemap(projection=projection, lon_0=0, resolution=resolution,
+                                         ax=self.ax)
+            m.drawmapboundary(linewidth=default_map_linewidth * scale)
+            m.drawcoastlines(linewidth=default_map_linewidth * scale, color='black')
+            m.drawcountries(linewidth=default_border_linewidth * scale, color='black')
+
+    def save(self, dest, artists):
+        """Saves the map with artists drawn on it, then removes them."""
+
+        try:
+            savefig(self.fig, dest)
+        finally:
+            for artist in artists:
+                artist.remove()
+
+    def dots(self, datafile, dest, size=6, color='red', descending=False, inputkwargs={},
+             scatter=True):
+        """Format: CSV with 'Latitude' and 'Longitude' columns."""
+
+        m, scale = self.m, self.scale
+        style = point_style(scale)
+
+        df = read_coordinates(datafile, ['Latitude', 'Longitude'], inputkwargs)
+        if scatter:
+            artists = [scatter_points(m, df['Latitude'].to_numpy(), df['Longitude'].to_numpy(),
+                                      size * scale, color, style)]
+        else:
+            coords = []
+
+            for f in df.itertuples():
+                coords.append((f.Latitude, f.Longitude))
+
+            artists = []
+            with instrument.span('plot.draw'):
+                for latitude, longitude in coords:
+                    artists.extend(m.plot(longitude, latitude, latlon=True, markersize=size * scale,
+                                          c=color, **style))
+            instrument.count('points_plotted', len(coords))
+
+        self.save(dest, artists)
+
+    def density(self, datafile, dest, gridsize=500, colorscale='viridis', usecol=None,
+                log=True, chunksize=None, inputkwargs={}):
+        """Format: CSV with 'Latitude' and 'Longitude' columns, and optionally a magnitude
+        column usecol.
+
+        Draws the number of points (or with usecol, the sum of their magnitudes) in each
+        cell of a grid gridsize cells wide over the map as a single image, so drawing
+        takes the same time however many points there are. Empty cells are left clear."""
+
+        m = self.m
+        extent = (m.llcrnrx, m.urcrnrx, m.llcrnry, m.urcrnry)
+        shape = (max(1, int(round(gridsize * (m.urcrnry - m.llcrnry) / (m.urcrnrx - m.llcrnrx)))),
+                 gridsize)
+        grid = np.zeros(shape)
+
+        usecols = ['Latitude', 'Longitude'] + ([usecol] if usecol else [])
+        for chunk in coordinate_chunks(datafile, usecols, chunksize, inputkwargs):
+            if usecol:
+                chunk = chunk.dropna(subset=[usecol])
+            with instrument.span('plot.project'):
+                x, y = m(chunk['Longitude'].to_numpy(), chunk['Latitude'].to_numpy())
+            with instrument.span('plot.bin'):
+                bin_points(grid, extent, x, y, chunk[usecol].to_numpy() if usecol else None)
+            instrument.count('points_binned', len(chunk))
+
+        with instrument.span('plot.draw'):
+            cells = np.ma.masked_less_equal(grid, 0)
+            norm = mcolors.LogNorm() if log else mcolors.Normalize()
+            image = m.imshow(cells, cmap=colorscale, norm=norm, interpolation='nearest',
+                             zorder=2)
+
+        self.save(dest, [image])
+
+    def prop_symbols(self, datafile, dest, bins, custom_style={}, sumatsamecoords=False,
+                     descending=False, usecol='Magnitude', inputkwargs={}, scatter=True,
+                     chunksize=None, snap=None):
+        """Format: CSV with 'Latitude', 'Longitude', and 'Magnitude' columns.
+
+        chunksize and snap are passed to read_magnitudes."""
+
+        m, scale = self.m, self.scale
+        style = point_style(scale, custom_style)
+
+        latitudes, longitudes, magnitudes = read_magnitudes(datafile, usecol, sumatsamecoords,
+                                                            descending, inputkwargs, chunksize,
+                                                            snap)
+
+        # Styles scatter can't reproduce are drawn a point at a time
+        if scatter and scatter_style(style) is not None:
+            sizes, colors = bins.lookup(magnitudes)
+
+            artists = [scatter_points(m, latitudes, longitudes, sizes * scale, colors, style)]
+        else:
+            artists = []
+            with instrument.span('plot.draw'):
+                for latitude, longitude, magnitude in zip(latitudes, longitudes, magnitudes):
+                    size, color = bins(magnitude)
+
+                    artists.extend(m.plot(longitude, latitude, latlon=True,
+                                          markersize=size * scale, c=color, **style))
+            instrument.count('points_plotted', len(magnitudes))
+
+        self.save(dest, artists)
+
+    def close(self):
+        plt.close(self.fig)
 
-    df = pd.read_csv(datafile, converters={'Latitude': util.parse_latlon,
-                                           'Longitude': util.parse_latlon},
-                     usecols=['Latitude', 'Longitude'], **inputkwargs)
-    coords = []
+def plot_dots(datafile, dest, size=6, color='red', scale=1,
+              projection='robin', resolution='l', descending=False, inputkwargs={},
+              scatter=True):
+    """Format: CSV with 'Latitude' and 'Longitude' columns."""
 
-    for f in df.itertuples():
-        coords.append((f.Latitude, f.Longitude))
+    PointMap(scale, projection, resolution).dots(datafile, dest, size, color, descending,
+                                                 inputkwargs, scatter)
 
-    for latitude, longitude in coords:
-        m.plot(longitude, latitude, latlon=True, markersize=size * scale, c=color, **style)
+def plot_density(datafile, dest, gridsize=500, colorscale='viridis', usecol=None, log=True,
+                 scale=1, projection='robin', resolution='l', chunksize=None, inputkwargs={}):
+    """Format: CSV with 'Latitude' and 'Longitude' columns, and optionally a magnitude
+    column usecol."""
 
-    plt.savefig(dest, bbox_inches='tight')
+    PointMap(scale, projection, resolution).density(datafile, dest, gridsize, colorscale, usecol,
+                                                    log, chunksize, inputkwargs)
 
 def plot_prop_symbols(datafile, dest, bins, custom_style={}, scale=1, sumatsamecoords=False,
                       projection='robin', resolution='l', descending=False, usecol='Magnitude',
-                      inputkwargs={}):
+                      inputkwargs={}, scatter=True, chunksize=None, snap=None):
     """Format: CSV with 'Latitude', 'Longitude', and 'Magnitude' columns."""
 
-    default_style = {'linestyle': 'none',
-                     'marker': 'o',
-                     'markeredgecolor': 'black',
-                     'markeredgewidth': 0.3 * scale}
+    PointMap(scale, projection, resolution).prop_symbols(datafile, dest, bins, custom_style,
+                                                         sumatsamecoords, descending, usecol,
+                                                         inputkwargs, scatter, chunksize, snap)
 
-    style = default_style.copy()
-    style.update(custom_style)
+def color_scheme(colorscale, bins):
+    # https://matplotlib.org/api/pyplot_summary.html#matplotlib.pyplot.colormaps
+    num_colors = len(bins) - 1
+    cm = plt.get_cmap(colorscale)
+    return [cm(i / num_colors) for i in range(num_colors)]
 
-    plt.figure(figsize=(default_size * scale, default_size * scale))
-    m = Basemap(projection=projection, lon_0=0, resolution=resolution)
-    m.drawmapboundary(linewidth=default_map_linewidth * scale)
-    m.drawcoastlines(linewidth=default_map_linewidth * scale, color='black')
-    m.drawcountries(linewidth=default_border_linewidth * scale, color='black')
+def check_unique_keys(index):
+    if index.has_duplicates:
+        duplicates = index[index.duplicated()].unique()
+        raise ValueError('Duplicate keys in data: %s' % ', '.join(map(repr, duplicates)))
 
-    df = pd.read_csv(datafile, converters={'Latitude': util.parse_latlon,
-                                           'Longitude': util.parse_latlon},
-                     usecols=['Latitude', 'Longitude', usecol], **inputkwargs)
+def make_bin_table(values, bins, equivalent_keys={}):
+    """Maps each key in the index of values to the bin its value falls in (per np.digitize).
 
-    magnitudes = defaultdict(int)
-    for f in df.itertuples():
-        magnitude = getattr(f, usecol)
-        if pd.notna(magnitude):
-            if sumatsamecoords:
-                magnitudes[(f.Latitude, f.Longitude)] += magnitude
-            else:
-                magnitudes[(f.Latitude, f.Longitude)] = magnitude
+    Keys in equivalent_keys that are missing from values take the bin of their equivalent."""
 
-    for (latitude, longitude), magnitude in sorted(magnitudes.items(), key=itemgetter(1),
-                                                   reverse=descending):
-            size, color = bins(magnitude)
+    check_unique_keys(values.index)
 
-            m.plot(longitude, latitude, latlon=True, markersize=size * scale, c=color, **style)
+    value_bins = np.digitize(values, bins) - 1
+    table = dict(zip(values.index.tolist(), value_bins.tolist()))
+    for key, equivalent in equivalent_keys.items():
+        if key not in table and equivalent in table:
+            table[key] = table[equivalent]
 
-    plt.savefig(dest, bbox_inches='tight')
+    return table
 
-def plot_world_chloropleth(datafile, dest, colorscale, bins, nodatacolor='#dddddd',
-                           scale=1, projection='robin', resolution='l', usecol='Magnitude',
-                           inputkwargs={}):
-    """Format: CSV with 'Country Name', 'Country Code', and 'Magnitude' columns."""
+def bin_colors(scheme, shape_bins, has_data, nodatacolor):
+    """Builds an RGBA face color array for shapes from their indices into scheme.
+
+    Shapes for which has_data is False get nodatacolor."""
+
+    facecolors = np.empty((len(shape_bins), 4))
+    facecolors[:] = mcolors.to_rgba(nodatacolor)
+    facecolors[has_data] = mcolors.to_rgba_array(scheme)[shape_bins[has_data]]
+    return facecolors
+
+def shape_colors(keys, bin_table, scheme, nodatacolor):
+    """Face colors for the shapes with the given keys."""
+
+    shape_bins = np.zeros(len(keys), dtype=np.intp)
+    has_data = np.zeros(len(keys), dtype=bool)
+    for i, key in enumerate(keys):
+        shape_bin = bin_table.get(key)
+        if shape_bin is not None:
+            shape_bins[i] = shape_bin
+            has_data[i] = True
+
+    return bin_colors(scheme, shape_bins, has_data, nodatacolor)
+
+def add_shapes(ax, shapes, facecolors):
+    """Adds all shapes to ax as a single PatchCollection, which is returned."""
+
+    with instrument.span('plot.draw'):
+        patches = [mpatches.Polygon(np.asarray(shape), closed=True) for shape in shapes]
+        pc = mcollections.PatchCollection(patches)
+        pc.set_facecolor(facecolors)
+        ax.add_collection(pc)
+    instrument.count('shapes_drawn', len(patches))
+    return pc
+
+def lod_tolerance(ax, xmin, xmax, ymin, ymax):
+    """The tolerance, in projected units, to simplify shapes drawn on ax over the given
+    extent by: lod_pixels of the saved image, rounded down to a power of two so that
+    similar scales share a cached level of detail."""
+
+    if not lod_pixels:
+        return None
+
+    fig = ax.figure
+    dpi = mpl.rcParams['savefig.dpi']
+    if dpi == 'figure':
+        dpi = fig.dpi
+    bbox = ax.get_position()
+    units_per_pixel = max((xmax - xmin) / (bbox.width * fig.get_figwidth() * dpi),
+                          (ymax - ymin) / (bbox.height * fig.get_figheight() * dpi))
+
+    return float(2 ** np.floor(np.log2(units_per_pixel * lod_pixels)))
+
+# Polygon indexes of shapefiles, with the key of each shape; see shape_index
+shape_indexes = {}
+
+def shape_index(shapefile, shape_key):
+    """Returns a PolygonIndex of the shapes of shapefile in longitude/latitude and the
+    shape_key of the info of each, building them on first use."""
+
+    if shapefile not in shape_indexes:
+        rings, info = shapecache.read_lonlat(shapefile)
+        owners = [i['SHAPENUM'] - 1 for i in info]
+        keys = [None] * (max(owners) + 1)
+        for owner, i in zip(owners, info):
+            keys[owner] = shape_key(i)
+        shape_indexes[shapefile] = spatialindex.PolygonIndex(rings, owners), keys
+
+    return shape_indexes[shapefile]
+
+def read_point_values(datafile, shapefile, shape_key, aggregate='count', usecol='Magnitude',
+                      chunksize=None, inputkwargs={}):
+    """Format: CSV with 'Latitude' and 'Longitude' columns, and for aggregate='sum' a
+    magnitude column usecol.
+
+    Locates each point in the shapes of shapefile, returning the number of points (or the
+    sum of their magnitudes) in each shape as a Series indexed by the shape_key of its info.
+    Shapes with no points have 0."""
+
+    if aggregate not in ('count', 'sum'):
+        raise ValueError('Unknown aggregate: %r' % aggregate)
+
+    index, keys = shape_index(shapefile, shape_key)
+    totals = np.zeros(index.num_owners)
+
+    usecols = ['Latitude', 'Longitude'] + ([usecol] if aggregate == 'sum' else [])
+    for chunk in coordinate_chunks(datafile, usecols, chunksize, inputkwargs):
+        weights = None
+        if aggregate == 'sum':
+            chunk = chunk.dropna(subset=[usecol])
+            weights = chunk[usecol].to_numpy()
+        with instrument.span('plot.locate'):
+            totals += index.aggregate(chunk['Longitude'].to_numpy(), chunk['Latitude'].to_numpy(),
+                                      weights)
+
+    # Shapes can share a key, e.g. the parts of a country stored as separate records
+    return pd.Series(totals, index=keys).groupby(level=0).sum()
+
+def read_country_values(datafile, usecol='Magnitude', inputkwargs={}):
+    df = read_table(datafile, inputkwargs)
+    df.set_index('Country Code', inplace=True)
+    check_unique_keys(df.index)
+    return df[usecol]
+
+class WorldChloropleth(object):
+    """A world map of country shapes, read and drawn once, which can be colored by any
+    number of datasets; each render only recolors the shapes and saves the map."""
 
     # See http://ramiro.org/notebook/basemap-choropleth/
     shapefile = 'ne_10m_admin_0_countries_lakes/ne_10m_admin_0_countries_lakes'
-    num_colors = len(bins) - 1
 
-    gc = GeonamesCache()
-    iso3_codes = list(gc.get_dataset_by_key(gc.get_countries(), 'iso3').keys())
+    def __init__(self, scale=1, projection='robin', resolution='l'):
+        gc = geonamescache.GeonamesCache()
+        self.iso3_codes = list(gc.get_dataset_by_key(gc.get_countries(), 'iso3').keys())
 
-    df = pd.read_csv(datafile, **inputkwargs)
-    df.set_index('Country Code', inplace=True)
-    df = df.reindex(iso3_codes)#.dropna() # Filter out non-countries and missing values.
+        # This doesn't work, is it important?
+        # mpl.style.use('map')
+        self.fig = fig = plt.figure(figsize=(default_size * scale, default_size * scale))
 
-    values = df[usecol]
-    # https://matplotlib.org/api/pyplot_summary.html#matplotlib.pyplot.colormaps
-    cm = plt.get_cmap(colorscale)
-    scheme = [cm(i / num_colors) for i in range(num_colors)]
-    scheme.append(nodatacolor)
-    df['bin'] = np.digitize(values, bins) - 1
-    df.sort_values('bin', ascending=False).head(10)
+        ax = fig.add_subplot(111, facecolor='w', frame_on=False)
 
-    # This doesn't work, is it important?
-    # mpl.style.use('map')
-    fig = plt.figure(figsize=(default_size * scale, default_size * scale))
+        with instrument.span('plot.basemap'):
+            self.m = m = basemap.Basemap(lon_0=0, projection=projection, resolution=resolution,
+                                         ax=ax)
+            m.drawmapboundary(linewidth=default_map_linewidth * scale, color='w')
 
-    ax = fig.add_subplot(111, facecolor='w', frame_on=False)
+        tolerance = lod_tolerance(ax, m.llcrnrx, m.urcrnrx, m.llcrnry, m.urcrnry)
+        shapes, info = shapecache.read_shapefile(m, self.shapefile, 'units', color='#444444',
+                                                 linewidth=default_border_linewidth * scale,
+                                                 tolerance=tolerance)
+        self.keys = [i['ADM0_A3'] for i in info]
+        self.pc = add_shapes(ax, shapes, 'none')
 
-    m = Basemap(lon_0=0, projection=projection, resolution=resolution)
-    m.drawmapboundary(linewidth=default_map_linewidth * scale, color='w')
+    def render(self, datafile, dest, colorscale, bins, nodatacolor='#dddddd', usecol='Magnitude',
+               inputkwargs={}, aggregate=None, chunksize=None):
+        """Format: CSV with 'Country Name', 'Country Code', and 'Magnitude' columns.
 
-    m.readshapefile(shapefile, 'units', color='#444444', linewidth=default_border_linewidth * scale)
-    for info, shape in zip(m.units_info, m.units):
-        iso3 = info['ADM0_A3']
-        if iso3 not in df.index:
-            color = nodatacolor
+        With aggregate ('count' or 'sum'), the CSV instead holds points, which are totalled
+        per country; see read_point_values."""
+
+        if aggregate:
+            values = read_point_values(datafile, self.shapefile, itemgetter('ADM0_A3'), aggregate,
+                                       usecol, chunksize, inputkwargs)
         else:
-            color = scheme[df.loc[iso3]['bin']]
+            values = read_country_values(datafile, usecol, inputkwargs)
+        values = values.reindex(self.iso3_codes)#.dropna() # Filter out non-countries and missing values.
 
-        patches = [Polygon(np.array(shape), True)]
-        pc = PatchCollection(patches)
-        pc.set_facecolor(color)
-        ax.add_collection(pc)
+        scheme = color_scheme(colorscale, bins)
+        scheme.append(nodatacolor)
+        bin_table = make_bin_table(values, bins)
 
-    plt.savefig(dest, bbox_inches='tight')
+        with instrument.span('plot.color_shapes'):
+            self.pc.set_facecolor(shape_colors(self.keys, bin_table, scheme, nodatacolor))
+        savefig(self.fig, dest)
+
+    def close(self):
+        plt.close(self.fig)
+
+def plot_world_chloropleth(datafile, dest, colorscale, bins, nodatacolor='#dddddd',
+                           scale=1, projection='robin', resolution='l', usecol='Magnitude',
+                           inputkwargs={}, aggregate=None, chunksize=None):
+    """Format: CSV with 'Country Name', 'Country Code', and 'Magnitude' columns, or with
+    aggregate, points; see WorldChloropleth.render."""
+
+    WorldChloropleth(scale, projection, resolution).render(datafile, dest, colorscale, bins,
+                                                           nodatacolor, usecol, inputkwargs,
+                                                           aggregate, chunksize)
 
 def parse_geography(geography):
     m = geography_parse_re.match(geography)
@@ -158,156 +588,266 @@ def parse_geography(geography):
     return state, county, suffix
 
 class GeoidLookup(object):
-    def __init__(self):
+    """Maps parsed county geographies to Geoids.
+
+    The mapping is compiled from census_file once and stored in index_file, which is
+    rebuilt whenever census_file changes; it is only loaded when first used."""
+
+    def __init__(self, census_file='data/Census.csv', index_file='cache/geoids.pickle'):
+        self.census_file = census_file
+        self.index_file = index_file
         self.geoid_mapping = None
 
+    def compile(self):
+        mapping = {}
+        with open(self.census_file, 'r') as fobj:
+            reader = csv.DictReader(fobj)
+            for row in reader:
+                geography = row['Geography']
+                state, county, suffix = parse_geography(geography)
+                geoid = int(row['Geoid'])
+                if suffix and (state, county) in mapping:
+                    mapping[(state, '%s%s' % (county, suffix))] = geoid
+                else:
+                    mapping[(state, county)] = geoid
+
+        return mapping
+
+    def load_index(self):
+        source = (os.path.abspath(self.census_file), os.path.getmtime(self.census_file))
+        try:
+            with open(self.index_file, 'rb') as fobj:
+                index_source, mapping = pickle.load(fobj)
+            if index_source == source:
+                return mapping
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+
+        mapping = self.compile()
+        if os.path.dirname(self.index_file):
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+        tmp_file = '%s.tmp%d' % (self.index_file, os.getpid())
+        with open(tmp_file, 'wb') as fobj:
+            pickle.dump((source, mapping), fobj, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self.index_file)
+
+        return mapping
+
     @property
     def geoids(self):
         if self.geoid_mapping is None:
-            mapping = {}
-            with open('data/Census.csv', 'r') as fobj:
-                reader = csv.DictReader(fobj)
-                for row in reader:
-                    geography = row['Geography']
-                    state, county, suffix = parse_geography(geography)
-                    geoid = int(row['Geoid'])
-                    if suffix and (state, county) in mapping:
-                        mapping[(state, '%s%s' % (county, suffix))] = geoid
-                    else:
-                        mapping[(state, county)] = geoid
-            self.geoid_mapping = mapping
+            with instrument.span('plot.geoid_index'):
+                self.geoid_mapping = self.load_index()
 
         return self.geoid_mapping
 
-lookup = GeoidLookup()
+    def lookup_many(self, geographies):
+        """Returns an array of the Geoids of a column of 'County, State' geographies."""
 
-def plot_us_chloropleth(datafile, dest, colorscale, bins, nodatacolor='#dddddd',
-                        scale=1, resolution='l', usecol='Magnitude',
-                        inputkwargs={}):
-    """Format: CSV with 'Geography', 'Geoid', and 'Magnitude' columns."""
+        geographies = pd.Series(geographies, dtype=object).reset_index(drop=True)
+        parts = geographies.str.extract(geography_parse_re)
+        unparsed = parts[0].isna()
+        if unparsed.any():
+            raise ValueError('Could not parse geography: %r' % geographies[unparsed].iloc[0])
 
-    shapefile = 'cb_2017_us_county_500k/cb_2017_us_county_500k'
-    num_colors = len(bins) - 1
+        counties = parts[0].str.lower().str.replace(' ', '', regex=False)
+        suffixes = parts[1].str.lower().fillna('')
+        states = parts[2].str.lower()
+
+        geoid_lookup = self.geoids
+        geoids = np.empty(len(geographies), dtype=np.uint32)
+        for i, (state, county, suffix) in enumerate(zip(states, counties, suffixes)):
+            geoid = None
+            if suffix:
+                geoid = geoid_lookup.get((state, '%s%s' % (county, suffix)))
+            if geoid is None:
+                geoid = geoid_lookup[(state, county)]
+            geoids[i] = geoid
 
-    gc = GeonamesCache()
-    # iso3_codes = list(gc.get_dataset_by_key(gc.get_countries(), 'iso3').keys())
+        return geoids
 
-    df = pd.read_csv(datafile, **inputkwargs)
-    geoid_lookup = lookup.geoids
+lookup = GeoidLookup()
+
+def read_county_values(datafile, usecol='Magnitude', inputkwargs={}):
+    df = read_table(datafile, inputkwargs)
     if 'Geoid' not in df:
-        geoids = np.empty(df.shape[0], dtype=np.uint32)
-        for index, row in df.iterrows():
-            if "Geography" in row:
-                geography = row['Geography']
-            else:
-                state = row['State']
-                county = row['County']
-                geography = '%s, %s' % (county, state)
-            state, county, suffix = parse_geography(geography)
-            if suffix and (state, '%s%s' % (county, suffix)) in geoid_lookup:
-                geoids[index] = geoid_lookup[(state, '%s%s' % (county, suffix))]
-            else:
-                geoids[index] = geoid_lookup[(state, county)]
-        df.insert(0, 'Geoid', geoids)
+        if 'Geography' in df:
+            geographies = df['Geography']
+        else:
+            geographies = df['County'].astype(str) + ', ' + df['State'].astype(str)
+        df.insert(0, 'Geoid', lookup.lookup_many(geographies))
     df.set_index('Geoid', inplace=True)
-    # df = df.loc[iso3_codes].dropna() # Filter out non-countries and missing values.
+    return df[usecol]
 
-    values = df[usecol]
-    # https://matplotlib.org/api/pyplot_summary.html#matplotlib.pyplot.colormaps
-    cm = plt.get_cmap(colorscale)
-    scheme = [cm(i / num_colors) for i in range(num_colors)]
-    df['bin'] = np.digitize(values, bins) - 1
-    df.sort_values('bin', ascending=False).head(10)
+def read_state_values(datafile, usecol='Magnitude', inputkwargs={}):
+    df = read_table(datafile, inputkwargs)
+    df.set_index('AFFGEOID', inplace=True)
+    return df[usecol]
 
-    # This doesn't work, is it important?
-    # mpl.style.use('map')
-    fig = plt.figure(figsize=(default_size * scale, default_size * scale))
-    grid = gs.GridSpec(nrows=10, ncols=10)
+class USChloropleth(object):
+    """A map of the US (with Alaska and Hawaii insets) of the shapes in a census shapefile,
+    read and drawn once, which can be colored by any number of datasets; each render only
+    recolors the shapes and saves the map.
 
-    for lon_0, lat_0, gridpos, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat in \
-        [(-98.5795, 39.828, grid[:-2, :], -121, 22, -64, 47), # Contiguous US
-         (-160, 63.5, grid[-4:, :6], -185.3, 49, -116, 65.5), # Alaska
-         (-158, 21, grid[-3:, 6:], -161, 18, -154, 23)]: # Hawaii
+    shape_key maps the info of each shape to the key of its row in the data."""
 
-        m = Basemap(lon_0=lon_0, lat_0=lat_0, projection='ortho', resolution=resolution)
-        ax = fig.add_subplot(gridpos, facecolor='#00000000', frame_on=False)
+    insets = [(-98.5795, 39.828, (slice(None, -2), slice(None)), -121, 22, -64, 47), # Contiguous US
+              (-160, 63.5, (slice(-4, None), slice(None, 6)), -185.3, 49, -116, 65.5), # Alaska
+              (-158, 21, (slice(-3, None), slice(6, None)), -161, 18, -154, 23)] # Hawaii
 
-        m.readshapefile(shapefile, 'units', color='#444444', linewidth=default_border_linewidth * scale)
-        for info, shape in zip(m.units_info, m.units):
-            geoid = int(info['GEOID'])
-            if geoid in equivalencies and geoid not in df.index:
-                geoid = equivalencies[geoid]
+    def __init__(self, shapefile, shape_key, scale=1, resolution='l'):
+        self.shapefile = shapefile
+        self.shape_key = shape_key
 
-            if geoid not in df.index:
-                color = nodatacolor
-            else:
-                color = scheme[df.loc[geoid]['bin']]
+        # This doesn't work, is it important?
+        # mpl.style.use('map')
+        self.fig = fig = plt.figure(figsize=(default_size * scale, default_size * scale))
+        grid = gs.GridSpec(nrows=10, ncols=10)
 
-            patches = [Polygon(np.array(shape), True)]
-            pc = PatchCollection(patches)
-            pc.set_facecolor(color)
-            ax.add_collection(pc)
+        self.layers = []
+        for lon_0, lat_0, gridpos, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat in self.insets:
+            ax = fig.add_subplot(grid[gridpos], facecolor='#00000000', frame_on=False)
+            with instrument.span('plot.basemap'):
+                m = basemap.Basemap(lon_0=lon_0, lat_0=lat_0, projection='ortho',
+                                    resolution=resolution, ax=ax)
 
-        xmin, ymin = m(llcrnrlon, llcrnrlat)
-        xmax, ymax = m(urcrnrlon, urcrnrlat)
+            xmin, ymin = m(llcrnrlon, llcrnrlat)
+            xmax, ymax = m(urcrnrlon, urcrnrlat)
 
-        ax.set_xlim(xmin, xmax)
-        ax.set_ylim(ymin, ymax)
+            tolerance = lod_tolerance(ax, xmin, xmax, ymin, ymax)
+            shapes, info = shapecache.read_shapefile(m, shapefile, 'units', color='#444444',
+                                                     linewidth=default_border_linewidth * scale,
+                                                     tolerance=tolerance)
+            keys = [shape_key(i) for i in info]
+            self.layers.append((keys, add_shapes(ax, shapes, 'none')))
 
+            ax.set_xlim(xmin, xmax)
+            ax.set_ylim(ymin, ymax)
 
-    plt.savefig(dest, bbox_inches='tight')
+    def render(self, values, dest, colorscale, bins, nodatacolor='#dddddd'):
+        """Colors each shape by the bin of its value in values (a Series indexed by shape key)."""
 
-def plot_us_state_chloropleth(datafile, dest, colorscale, bins, nodatacolor='#dddddd',
-                              scale=1, resolution='l', usecol='Magnitude',
-                              inputkwargs={}):
-    """Format: CSV with 'Geography', 'AFFGEOID', and 'Magnitude' columns."""
+        scheme = color_scheme(colorscale, bins)
+        bin_table = make_bin_table(values, bins, equivalencies)
 
-    shapefile = 'cb_2017_us_state_500k/cb_2017_us_state_500k'
-    num_colors = len(bins) - 1
+        with instrument.span('plot.color_shapes'):
+            for keys, pc in self.layers:
+                pc.set_facecolor(shape_colors(keys, bin_table, scheme, nodatacolor))
+        savefig(self.fig, dest)
 
-    gc = GeonamesCache()
+    def close(self):
+        plt.close(self.fig)
 
-    df = pd.read_csv(datafile, **inputkwargs)
-    df.set_index('AFFGEOID', inplace=True)
+class USCountyChloropleth(USChloropleth):
+    shapefile = 'cb_2017_us_county_500k/cb_2017_us_county_500k'
 
-    values = df[usecol]
-    # https://matplotlib.org/api/pyplot_summary.html#matplotlib.pyplot.colormaps
-    cm = plt.get_cmap(colorscale)
-    scheme = [cm(i / num_colors) for i in range(num_colors)]
-    df['bin'] = np.digitize(values, bins) - 1
-    df.sort_values('bin', ascending=False).head(10)
+    def __init__(self, scale=1, resolution='l'):
+        USChloropleth.__init__(self, self.shapefile, lambda info: int(info['GEOID']), scale,
+                               resolution)
 
-    fig = plt.figure(figsize=(default_size * scale, default_size * scale))
-    grid = gs.GridSpec(nrows=10, ncols=10)
+    def render(self, datafile, dest, colorscale, bins, nodatacolor='#dddddd', usecol='Magnitude',
+               inputkwargs={}, aggregate=None, chunksize=None):
+        """Format: CSV with 'Geography', 'Geoid', and 'Magnitude' columns.
 
-    for lon_0, lat_0, gridpos, llcrnrlon, llcrnrlat, urcrnrlon, urcrnrlat in \
-        [(-98.5795, 39.828, grid[:-2, :], -121, 22, -64, 47), # Contiguous US
-         (-160, 63.5, grid[-4:, :6], -185.3, 49, -116, 65.5), # Alaska
-         (-158, 21, grid[-3:, 6:], -161, 18, -154, 23)]: # Hawaii
+        With aggregate ('count' or 'sum'), the CSV instead holds points, which are totalled
+        per county; see read_point_values."""
 
-        m = Basemap(lon_0=lon_0, lat_0=lat_0, projection='ortho', resolution=resolution)
-        ax = fig.add_subplot(gridpos, facecolor='#00000000', frame_on=False)
+        if aggregate:
+            values = read_point_values(datafile, self.shapefile, self.shape_key, aggregate,
+                                       usecol, chunksize, inputkwargs)
+        else:
+            values = read_county_values(datafile, usecol, inputkwargs)
+        USChloropleth.render(self, values, dest, colorscale, bins, nodatacolor)
 
-        m.readshapefile(shapefile, 'units', color='#444444', linewidth=default_border_linewidth * scale)
-        for info, shape in zip(m.units_info, m.units):
-            geoid = info['AFFGEOID']
-            if geoid in equivalencies and geoid not in df.index:
-                geoid = equivalencies[geoid]
+class USStateChloropleth(USChloropleth):
+    shapefile = 'cb_2017_us_state_500k/cb_2017_us_state_500k'
 
-            if geoid not in df.index:
-                color = nodatacolor
-            else:
-                color = scheme[df.loc[geoid]['bin']]
+    def __init__(self, scale=1, resolution='l'):
+        USChloropleth.__init__(self, self.shapefile, itemgetter('AFFGEOID'), scale, resolution)
 
-            patches = [Polygon(np.array(shape), True)]
-            pc = PatchCollection(patches)
-            pc.set_facecolor(color)
-            ax.add_collection(pc)
+    def render(self, datafile, dest, colorscale, bins, nodatacolor='#dddddd', usecol='Magnitude',
+               inputkwargs={}, aggregate=None, chunksize=None):
+        """Format: CSV with 'Geography', 'AFFGEOID', and 'Magnitude' columns.
 
-        xmin, ymin = m(llcrnrlon, llcrnrlat)
-        xmax, ymax = m(urcrnrlon, urcrnrlat)
+        With aggregate ('count' or 'sum'), the CSV instead holds points, which are totalled
+        per state; see read_point_values."""
 
-        ax.set_xlim(xmin, xmax)
-        ax.set_ylim(ymin, ymax)
+        if aggregate:
+            values = read_point_values(datafile, self.shapefile, self.shape_key, aggregate,
+                                       usecol, chunksize, inputkwargs)
+        else:
+            values = read_state_values(datafile, usecol, inputkwargs)
+        USChloropleth.render(self, values, dest, colorscale, bins, nodatacolor)
 
-    plt.savefig(dest, bbox_inches='tight')
+def plot_us_chloropleth(datafile, dest, colorscale, bins, nodatacolor='#dddddd',
+                        scale=1, resolution='l', usecol='Magnitude',
+                        inputkwargs={}, aggregate=None, chunksize=None):
+    """Format: CSV with 'Geography', 'Geoid', and 'Magnitude' columns, or with aggregate,
+    points; see USCountyChloropleth.render."""
+
+    USCountyChloropleth(scale, resolution).render(datafile, dest, colorscale, bins, nodatacolor,
+                                                  usecol, inputkwargs, aggregate, chunksize)
+
+def plot_us_state_chloropleth(datafile, dest, colorscale, bins, nodatacolor='#dddddd',
+                              scale=1, resolution='l', usecol='Magnitude',
+                              inputkwargs={}, aggregate=None, chunksize=None):
+    """Format: CSV with 'Geography', 'AFFGEOID', and 'Magnitude' columns, or with aggregate,
+    points; see USStateChloropleth.render."""
+
+    USStateChloropleth(scale, resolution).render(datafile, dest, colorscale, bins, nodatacolor,
+                                                 usecol, inputkwargs, aggregate, chunksize)
+
+def main():
+    parser = argparse.ArgumentParser(description='Renders the maps described by a job file.')
+
+    parser.add_argument('jobfile', help='JSON or YAML job file; see batch.read_job_file')
+    parser.add_argument('-j', '--processes', type=int, default=1,
+                        help='Number of processes to render with (0 for one per core)')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print the setup and render time of each job')
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the run and print the most expensive calls (only with '
+                             '-j 1, as other processes are not profiled)')
+    parser.add_argument('--backend', default='Agg', help='matplotlib backend')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write timing spans, counters and peak memory of the run to FILE as JSON')
+
+    args = parser.parse_args()
+    if args.profile and args.processes != 1:
+        parser.error('--profile only profiles this process, so needs -j 1')
+
+    import batch
+
+    if args.metrics:
+        instrument.enable()
+    init(backend=args.backend)
+    jobs = batch.read_job_file(args.jobfile)
+
+    if args.profile:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        results = profiler.runcall(batch.render_parallel, jobs, 1, args.backend)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+    else:
+        results = batch.render_parallel(jobs, args.processes or None, args.backend)
+
+    if args.timings:
+        print('setup_s\trender_s\tfunction\tdest')
+        for result in results:
+            print('%.3f\t%.3f\t%s\t%s' % (result['setup_seconds'], result['render_seconds'],
+                                           result['function'], result['dest']))
+        print('%.3f\t%.3f\ttotal' % (sum(r['setup_seconds'] for r in results),
+                                      sum(r['render_seconds'] for r in results)))
+
+    failures = [result for result in results if result['error']]
+    if args.metrics:
+        instrument.write_report(args.metrics, jobs=len(results), failures=len(failures))
+    for result in failures:
+        print('%s -> %s failed:\n%s' % (result['datafile'], result['dest'], result['error']),
+              file=sys.stderr)
+    if failures:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -7,14 +7,95 @@ import os.path
 import operator
 import itertools
 import csv
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, Future
 
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+
+from pagecache import PageCache, CoordinateCache
+import instrument
 
 google_maps_url_re = re.compile(r'http(?:s)?://www.google.com/maps/[^@]*@(\-?\d+\.\d+),(\-?\d+\.\d+)')
 wikipedia_url_re = re.compile(r'http(?:s)?://(\w+).wikipedia.org/wiki/')
 
+# Relative article links in scraped tables are resolved against this
+wikipedia_base_url = 'https://en.wikipedia.org'
+
+class TokenBucket(object):
+    """Thread-safe token bucket rate limiter: allows rate acquisitions per second on
+    average, in bursts of up to capacity."""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve a token even if none is available yet, so waiting callers queue up
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+    def __repr__(self):
+        return 'TokenBucket(%r, capacity=%r)' % (self.rate, self.capacity)
+
+# Limits requests for Wikipedia articles; see set_rate_limit
+rate_limiter = TokenBucket(1)
+
+def set_rate_limit(rate, capacity=1):
+    """Sets the maximum rate of Wikipedia article requests per second; None or 0 for no limit."""
+
+    global rate_limiter
+    rate_limiter = TokenBucket(rate, capacity) if rate else None
+
+# Persistent caches of fetched pages and of the coordinates scraped from articles;
+# see configure_cache
+page_cache = None
+coordinate_cache = None
+
+def configure_cache(path, **kwargs):
+    """Serves all page fetches through a PageCache at path, and caches the coordinates
+    scraped from articles in the same database (None to disable caching)."""
+
+    global page_cache, coordinate_cache
+    for cache in (page_cache, coordinate_cache):
+        if cache is not None:
+            cache.close()
+
+    if path:
+        page_cache = PageCache(path, fetch=fetch_url, **kwargs)
+        coordinate_cache = CoordinateCache(path)
+    else:
+        page_cache = coordinate_cache = None
+
+def fetch_url(url):
+    """Fetches url (or a Request) from the network, subject to the rate limit."""
+
+    if rate_limiter is not None:
+        with instrument.span('scrape.rate_limit'):
+            rate_limiter.acquire()
+    instrument.count('http_fetches')
+    with instrument.span('scrape.fetch'):
+        return urlopen(url)
+
+def open_url(url):
+    """Opens url through the page cache, if one is configured."""
+
+    if page_cache is not None:
+        return page_cache.open(url)
+    return fetch_url(url)
+
 def expand_wikipedia_url(url):
-    return 'https://en.wikipedia.org%s' % url
+    return '%s%s' % (wikipedia_base_url, url)
 
 def scrape_url(url):
     if not url:
@@ -30,9 +111,49 @@ def scrape_url(url):
 
     raise ValueError('No rules defined for scraping the URL %s' % url)
 
+default_path = [('span', {'id': 'coordinates'})]
+
+def path_key(path=None):
+    """Canonical string form of a scrape path, for use as a cache key."""
+
+    if path is None:
+        path = default_path
+    return repr([(name, sorted(kwargs.items())) for name, kwargs in path])
+
+def class_matcher(css_class):
+    """Matches a class attribute the way find(class_=css_class) does. SoupStrainer sees
+    the unsplit attribute while parsing, so plain strings don't match multi-valued classes."""
+
+    def match(classes):
+        if classes is None:
+            return False
+        if isinstance(classes, str):
+            return css_class == classes or css_class in classes.split()
+        return css_class == ' '.join(classes) or css_class in classes
+
+    return match
+
+def path_strainer(path=None):
+    """Returns a SoupStrainer that only keeps the subtrees matched by the first step of
+    path, which is all scrape_wikipedia_element needs, or None if it can't be strained."""
+
+    if path is None:
+        path = default_path
+    if not path:
+        return None
+
+    name, kwargs = path[0]
+    if 'recursive' in kwargs:
+        return None
+    kwargs = dict(kwargs)
+    for key in ('class_', 'class'):
+        if isinstance(kwargs.get(key), str):
+            kwargs[key] = class_matcher(kwargs[key])
+    return SoupStrainer(name, **kwargs)
+
 def scrape_wikipedia_element(soup, path=None):
     if path is None:
-        path = [('span', {'id': 'coordinates'})]
+        path = default_path
 
     for name, kwargs in path:
         soup = soup.find(name, **kwargs)
@@ -49,16 +170,29 @@ def scrape_wikipedia_element(soup, path=None):
     return lat, lon
 
 def scrape_wikipedia_url(url, path=None):
+    if coordinate_cache is not None:
+        key = path_key(path)
+        hit, coords = coordinate_cache.get(url, key)
+        if hit:
+            instrument.count('coordinate_cache_hits')
+            return coords
+        instrument.count('coordinate_cache_misses')
+
     try:
-        with urlopen(url) as fobj:
-            time.sleep(1)
-            soup = BeautifulSoup(fobj, 'lxml')
+        with open_url(url) as fobj, instrument.span('scrape.parse'):
+            soup = BeautifulSoup(fobj, 'lxml', parse_only=path_strainer(path))
 
-            return scrape_wikipedia_element(soup, path)
+            coords = scrape_wikipedia_element(soup, path)
 
     except HTTPError as ex:
         return None
 
+    if coordinate_cache is not None:
+        coordinate_cache.put(url, key, coords)
+    return coords
+
+table_strainer = SoupStrainer('table', class_=class_matcher('sortable'))
+
 def parse_table_headers(table):
     row = table.find('tr')
     header_info = []
@@ -117,15 +251,44 @@ def location_from_column(col, path=None):
 
     return lat, lon, url
 
+def read_checkpoint(checkpoint_file, out):
+    """Returns the set of table rows recorded in checkpoint_file, truncating out to the end
+    of the last of them to drop any partially written row."""
+
+    if not os.path.isfile(checkpoint_file) or not os.path.isfile(out):
+        return set()
+
+    done = set()
+    offset = 0
+    with open(checkpoint_file, 'r') as fobj:
+        for line in fobj:
+            if not line.endswith('\n'):
+                # Incomplete last line
+                break
+            i, offset = map(int, line.split('\t'))
+            done.add(i)
+
+    if done:
+        os.truncate(out, offset)
+    return done
+
 def scrape_wikipedia_table_url(url, table_index=0, preview=False, row_filter=None, limit=0, path=None,
 
                                magnitude_column=None, location_column=None, name_column=None,
                                backup_location_column=None,
 
-                               out=None, write_headers=True, out_transform=None):
+                               out=None, write_headers=True, out_transform=None, workers=1,
+                               resume=False):
+    """Scrapes the locations of the rows of a sortable table on a Wikipedia page.
 
-    with urlopen(url) as fobj:
-        soup = BeautifulSoup(fobj, 'lxml')
+    Rows are written to out as soon as they are finished. When out is a filename, the
+    table index of each written row and the output offset after it are recorded in
+    out + '.checkpoint'; with resume, rows recorded there are skipped and output is
+    appended after the last of them. The checkpoint is removed once the table is done."""
+
+    with open_url(url) as fobj:
+        with instrument.span('scrape.parse'):
+            soup = BeautifulSoup(fobj, 'lxml', parse_only=table_strainer)
 
         tables = soup.find_all('table', class_='sortable')
         table = tables[table_index]
@@ -155,30 +318,31 @@ def scrape_wikipedia_table_url(url, table_index=0, preview=False, row_filter=Non
         if backup_location_column:
             backup_loc_index = headers.index(backup_location_column)
 
+        done = set()
+        checkpoint_file = None
+        if out and isinstance(out, str):
+            checkpoint_file = out + '.checkpoint'
+            if resume:
+                done = read_checkpoint(checkpoint_file, out)
+
         out_headers = ['Name', 'Magnitude', 'Latitude', 'Longitude', 'Loc_url', 'Loc_url2']
         if out:
             if isinstance(out, str):
-                fobj = open(out, 'w')
+                fobj = open(out, 'a' if done else 'w')
                 writer = csv.DictWriter(fobj, delimiter='\t' if out.lower().endswith('.tsv') else ',',
                                         fieldnames=out_headers)
             else:
                 fobj = out
                 writer = csv.DictWriter(fobj, delimiter=',', fieldnames=out_headers)
-            writerow = writer.writerow
+            writeheader = writer.writeheader
+            def writerow(row):
+                writer.writerow(row)
+                fobj.flush()
         else:
-            writerow = lambda row: print('\t'.join([row[h] for h in out_headers]))
-
-        if write_headers:
-            writerow()
-        for i, row in enumerate(itertools.chain([first_data_row], first_data_row.find_next_siblings('tr'))):
-            cols = row.find_all(['th', 'td'])
-            if len(cols) < num_cols:
-                continue
-            if row_filter and not row_filter(cols):
-                continue
-            if limit and i >= limit:
-                break
+            writeheader = lambda: print('\t'.join(out_headers), flush=True)
+            writerow = lambda row: print('\t'.join([row[h] for h in out_headers]), flush=True)
 
+        def process_row(cols):
             if name_column:
                 name = ' '.join(cols[name_index].stripped_strings)
             else:
@@ -198,26 +362,89 @@ def scrape_wikipedia_table_url(url, table_index=0, preview=False, row_filter=Non
                 else:
                     lat, lon, loc_url2 = '', '', ''
 
-            out_row = {'Name': name, 'Magnitude': magnitude, 'Latitude': lat,
-                       'Longitude': lon, 'Loc_url': loc_url, 'Loc_url2': loc_url2}
-            if out_transform:
-                out_row = out_transform(out_row)
-            writerow(out_row)
+            return {'Name': name, 'Magnitude': magnitude, 'Latitude': lat,
+                    'Longitude': lon, 'Loc_url': loc_url, 'Loc_url2': loc_url2}
 
-        if out and isinstance(out, str):
-            fobj.close()
+        rows = []
+        for i, row in enumerate(itertools.chain([first_data_row], first_data_row.find_next_siblings('tr'))):
+            cols = row.find_all(['th', 'td'])
+            if len(cols) < num_cols:
+                continue
+            if row_filter and not row_filter(cols):
+                continue
+            if limit and i >= limit:
+                break
+            if i not in done:
+                rows.append((i, cols))
+
+        if write_headers and not done:
+            writeheader()
+
+        checkpoint = open(checkpoint_file, 'a' if done else 'w') if checkpoint_file else None
+        # Rows are fetched concurrently but written in table order
+        executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        try:
+            out_rows = executor.map(process_row, [cols for i, cols in rows])
+            for (i, cols), out_row in zip(rows, out_rows):
+                if out_transform:
+                    out_row = out_transform(out_row)
+                writerow(out_row)
+                if checkpoint:
+                    checkpoint.write('%d\t%d\n' % (i, fobj.tell()))
+                    checkpoint.flush()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            if checkpoint:
+                checkpoint.close()
+            if out and isinstance(out, str):
+                fobj.close()
+
+        if checkpoint_file:
+            os.remove(checkpoint_file)
 
     return []
 
-def scrape_coordinates(urlfile):
-    urls = open(urlfile, 'r').read().split('\n')
+def completed_future(func, *args):
+    """Calls func right away, returning its result or exception as a completed Future."""
+
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception as ex:
+        future.set_exception(ex)
+    return future
+
+def scrape_coordinates(urlfile, workers=1, window=None):
+    """Yields (url, coordinates) for each line of urlfile, in order.
+
+    The file is streamed. URLs that only need a regex are resolved immediately, while
+    Wikipedia URLs are deduplicated and fetched on a pool of workers; results are yielded
+    as soon as all of the lines before them are done. At most window lines (by default
+    64 per worker) are read ahead of the first unfinished one."""
+
+    workers = max(workers, 1)
+    if window is None:
+        window = workers * 64
+
     url_map = {}
-    for url in urls:
-        if url in url_map:
-            yield url, url_map[url]
-        else:
-            loc = url_map[url] = scrape_url(url)
-            yield url, loc
+    pending = collections.deque()
+    with open(urlfile, 'r') as fobj, ThreadPoolExecutor(max_workers=workers) as executor:
+        for line in fobj:
+            url = line.rstrip('\n')
+            if url not in url_map:
+                if url and wikipedia_url_re.match(url):
+                    url_map[url] = executor.submit(scrape_url, url)
+                else:
+                    url_map[url] = completed_future(scrape_url, url)
+            pending.append((url, url_map[url]))
+
+            while pending and (pending[0][1].done() or len(pending) > window):
+                url, future = pending.popleft()
+                yield url, future.result()
+
+        while pending:
+            url, future = pending.popleft()
+            yield url, future.result()
 
 def format_coords(coordinates):
     if coordinates:
@@ -239,26 +466,53 @@ def main():
     parser.add_argument('-n', '--name-column')
     parser.add_argument('--limit', type=int, default=0)
     parser.add_argument('-o', '--out')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip rows already written to --out by an interrupted run')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of Wikipedia articles to fetch concurrently')
+    parser.add_argument('--rate', type=float, default=1,
+                        help='Maximum Wikipedia article requests per second (0 for no limit)')
+    parser.add_argument('--cache', default='cache/pages.sqlite',
+                        help='Path of the persistent page cache')
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--cache-ttl', type=float, default=7 * 24,
+                        help='Hours before cached pages are revalidated')
+    parser.add_argument('--cache-size', type=int, default=512,
+                        help='Maximum size of the page cache in MB')
+    parser.add_argument('--offline', action='store_true',
+                        help='Only serve pages from the cache')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write timing spans, counters and peak memory of the run to FILE as JSON')
 
     args = parser.parse_args()
     url = args.urlfile
+    if args.metrics:
+        instrument.enable()
+    set_rate_limit(args.rate)
+    if not args.no_cache:
+        configure_cache(args.cache, ttl=args.cache_ttl * 60 * 60,
+                        max_size=args.cache_size * 1024 * 1024, offline=args.offline)
 
-    m = wikipedia_url_re.match(url)
-    if m:
-        try:
-            scrape_wikipedia_table_url(url, args.table_index, preview=args.preview,
-                            magnitude_column=args.magnitude_column, location_column=args.location_column,
-                            name_column=args.name_column, backup_location_column=args.backup_location_column,
-                            limit=args.limit, out=args.out)
-        except ValueError as ex:
-            import traceback
-            traceback.print_exc()
+    try:
+        m = wikipedia_url_re.match(url)
+        if m:
+            try:
+                scrape_wikipedia_table_url(url, args.table_index, preview=args.preview,
+                                magnitude_column=args.magnitude_column, location_column=args.location_column,
+                                name_column=args.name_column, backup_location_column=args.backup_location_column,
+                                limit=args.limit, out=args.out, workers=args.workers, resume=args.resume)
+            except ValueError as ex:
+                import traceback
+                traceback.print_exc()
+                print(format_coords(scrape_url(url)))
+        elif os.path.isfile(url):
+            for url, coordinates in scrape_coordinates(url, workers=args.workers):
+                print(format_coords(coordinates))
+        else:
             print(format_coords(scrape_url(url)))
-    elif os.path.isfile(url):
-        for url, coordinates in scrape_coordinates(url):
-            print(format_coords(coordinates))
-    else:
-        print(format_coords(scrape_url(url)))
+    finally:
+        if args.metrics:
+            instrument.write_report(args.metrics)
 
 if __name__ == "__main__":
     main()
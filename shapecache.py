@@ -0,0 +1,276 @@
+import os
+import os.path
+import shutil
+import hashlib
+import pickle
+
+import instrument
+from util import LazyModule
+
+np = LazyModule('numpy')
+mcollections = LazyModule('matplotlib.collections')
+pyshp = LazyModule('shapefile')
+
+def init():
+    np.import_now()
+    mcollections.import_now()
+
+# Projected shapefile geometry is cached here, one directory per shapefile/projection.
+# Set to None to disable caching.
+cache_dir = 'cache/shapes'
+
+def cache_key(m, shapefile):
+    """Identifies a shapefile projected by a Basemap: its path and mtime, the projection
+    parameters, the map corners and the resolution."""
+
+    mtime = os.path.getmtime(shapefile + '.shp')
+    corners = (m.llcrnrlon, m.llcrnrlat, m.urcrnrlon, m.urcrnrlat)
+    ident = repr((os.path.abspath(shapefile), mtime, sorted(m.projparams.items()),
+                  [float(c) for c in corners], m.resolution))
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+def load_shapes(path):
+    """Loads cached shapes as memory-mapped arrays."""
+
+    coords = np.load(os.path.join(path, 'coords.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(path, 'offsets.npy'))
+    with open(os.path.join(path, 'info.pickle'), 'rb') as fobj:
+        info = pickle.load(fobj)
+
+    shapes = [coords[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    return shapes, info
+
+def save_shapes(path, shapes, info):
+    """Writes projected shapes to path, replacing it atomically."""
+
+    arrays = [np.asarray(shape, dtype=np.float64).reshape(-1, 2) for shape in shapes]
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(a) for a in arrays])
+    if arrays:
+        coords = np.concatenate(arrays)
+    else:
+        coords = np.empty((0, 2), dtype=np.float64)
+
+    tmp_path = '%s.tmp%d' % (path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    np.save(os.path.join(tmp_path, 'coords.npy'), coords)
+    np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+    with open(os.path.join(tmp_path, 'info.pickle'), 'wb') as fobj:
+        pickle.dump(list(info), fobj, pickle.HIGHEST_PROTOCOL)
+
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process got there first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def douglas_peucker(coords, ids, keep, tolerance):
+    """Douglas-Peucker simplification of many polylines at once, returning the mask of
+    the points of coords that are kept.
+
+    keep marks the points that must be kept, which must include both ends of every
+    polyline; each stretch between kept points is split at its furthest point until none
+    is further than tolerance from it. Distances are measured from the end with the lower
+    vertex id, and ties go to the lowest id, so that a stretch is simplified the same way
+    whichever direction it runs in."""
+
+    keep = keep.copy()
+    active = np.flatnonzero(~keep)
+    while len(active):
+        kept = np.flatnonzero(keep)
+        stretch = np.searchsorted(kept, active)
+        left, right = kept[stretch - 1], kept[stretch]
+        swap = ids[left] > ids[right]
+        start, end = np.where(swap, right, left), np.where(swap, left, right)
+
+        dx, dy = (coords[end] - coords[start]).T
+        rx, ry = (coords[active] - coords[start]).T
+        length = np.hypot(dx, dy)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dists = np.where(length > 0, np.abs(dx * ry - dy * rx) / length, np.hypot(rx, ry))
+
+        # The active points of each stretch are contiguous
+        new_stretch = np.ones(len(active), dtype=bool)
+        new_stretch[1:] = stretch[1:] != stretch[:-1]
+        firsts = np.flatnonzero(new_stretch)
+        group = np.cumsum(new_stretch) - 1
+        max_dists = np.maximum.reduceat(dists, firsts)[group]
+        active_ids = ids[active]
+        lowest = np.minimum.reduceat(np.where(dists == max_dists, active_ids, len(ids)), firsts)
+        splits = np.flatnonzero((dists == max_dists) & (active_ids == lowest[group]) &
+                                (max_dists > tolerance))
+        splits = splits[np.unique(group[splits], return_index=True)[1]]
+        keep[active[splits]] = True
+
+        active = active[(max_dists > tolerance) & ~keep[active]]
+
+    return keep
+
+def vertex_signatures(coords, owners):
+    """Returns the id of each vertex in coords (equal for equal coordinates) and a
+    signature of the set of owners sharing it."""
+
+    vertex_ids = np.unique(coords.view(np.complex128).reshape(-1), return_inverse=True)[1]
+    vertex_ids = vertex_ids.reshape(-1)
+
+    # Sum a random key per owner over the distinct owners of each vertex
+    num_owners = owners.max() + 1
+    pairs = np.sort(vertex_ids * num_owners + owners)
+    pairs = pairs[np.append(True, pairs[1:] != pairs[:-1])]
+    keys = np.random.RandomState(0).randint(1, 2 ** 62, size=num_owners, dtype=np.int64).astype(np.uint64)
+    signatures = np.zeros(vertex_ids.max() + 1, dtype=np.uint64)
+    np.add.at(signatures, pairs // num_owners, keys[pairs % num_owners])
+
+    return vertex_ids, signatures[vertex_ids]
+
+def pin_ring(ids, signatures):
+    """Returns the order to visit a ring's points in, starting and ending at a pinned
+    point, and the mask of its pinned points: those where the set of shapes sharing the
+    border changes. Rings without any start at their lowest vertex id, as any other ring
+    with the same border will."""
+
+    pinned = (signatures != np.roll(signatures, 1)) | (signatures != np.roll(signatures, -1))
+    first = np.argmax(pinned) if pinned.any() else np.argmin(ids)
+    pinned[first] = True
+
+    order = np.roll(np.arange(len(ids)), -first)
+    return np.append(order, first), np.append(pinned[order], True)
+
+def simplify_shapes(shapes, info, tolerance):
+    """Simplifies the rings of shapes (as read by Basemap.readshapefile, with one entry per
+    ring) to within tolerance, in projected units.
+
+    Borders shared by several shapes are simplified identically on each, so neighbouring
+    shapes still meet without gaps or overlaps. Rings that would be left with fewer than
+    three points are kept as they are."""
+
+    rings = [np.asarray(shape, dtype=np.float64).reshape(-1, 2) for shape in shapes]
+    # Drop the closing point; rings are closed again below
+    rings = [ring[:-1] if len(ring) > 1 and (ring[0] == ring[-1]).all() else ring
+             for ring in rings]
+    lengths = [len(ring) for ring in rings]
+    if not rings or not sum(lengths):
+        return rings
+
+    owners = [i.get('SHAPENUM', n) if isinstance(i, dict) else n for n, i in enumerate(info)]
+    coords = np.ascontiguousarray(np.concatenate(rings))
+    ids, signatures = vertex_signatures(coords, np.repeat(np.asarray(owners, dtype=np.int64),
+                                                          lengths))
+
+    # Lay out every ring, rotated to start and end at a pinned point, end to end
+    orders, pins = [], []
+    offset = 0
+    for length in lengths:
+        if length:
+            order, pinned = pin_ring(ids[offset:offset + length], signatures[offset:offset + length])
+            orders.append(order + offset)
+            pins.append(pinned)
+        offset += length
+    order = np.concatenate(orders)
+    keep = douglas_peucker(coords[order], ids[order], np.concatenate(pins), tolerance)
+
+    simplified = []
+    offset = 0
+    for ring in rings:
+        if not len(ring):
+            simplified.append(ring)
+            continue
+        ring_keep = keep[offset:offset + len(ring) + 1]
+        if ring_keep.sum() < 4:
+            simplified.append(np.append(ring, ring[:1], axis=0))
+        else:
+            simplified.append(coords[order[offset:offset + len(ring) + 1][ring_keep]])
+        offset += len(ring) + 1
+
+    return simplified
+
+def cached_shapes(path, build):
+    """Loads shapes cached at path, or builds them and caches them there (unless path is None)."""
+
+    if path is not None and os.path.isdir(path):
+        instrument.count('shape_cache_hits')
+        return load_shapes(path)
+
+    shapes, info = build()
+    instrument.count('shape_cache_misses')
+    if path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        save_shapes(path, shapes, info)
+    return shapes, info
+
+def read_lonlat(shapefile):
+    """Reads the polygon rings of a shapefile in longitude/latitude, caching them like
+    read_shapefile. Returns the rings and their info, which (as with readshapefile) is the
+    record of each ring's shape with its 'SHAPENUM' and 'RINGNUM', counting from 1."""
+
+    def read():
+        rings, info = [], []
+        reader = pyshp.Reader(shapefile)
+        try:
+            for shapenum, shape_record in enumerate(reader.iterShapeRecords(), 1):
+                points = np.asarray(shape_record.shape.points, dtype=np.float64).reshape(-1, 2)
+                parts = list(shape_record.shape.parts) + [len(points)]
+                record = shape_record.record.as_dict()
+                for ringnum, (start, end) in enumerate(zip(parts[:-1], parts[1:]), 1):
+                    rings.append(points[start:end])
+                    info.append(dict(record, RINGNUM=ringnum, SHAPENUM=shapenum))
+        finally:
+            reader.close()
+        return rings, info
+
+    path = None
+    if cache_dir is not None:
+        mtime = os.path.getmtime(shapefile + '.shp')
+        ident = repr((os.path.abspath(shapefile), mtime, 'lonlat'))
+        path = os.path.join(cache_dir, hashlib.sha1(ident.encode('utf-8')).hexdigest())
+
+    with instrument.span('shapes.read'):
+        return cached_shapes(path, read)
+
+def read_shapefile(m, shapefile, name, drawbounds=True, color='k', linewidth=0.5, ax=None,
+                   tolerance=None):
+    """Drop-in replacement for Basemap.readshapefile that caches the projected geometry
+    on disk, so repeat renders skip parsing and projecting the shapefile.
+
+    With tolerance, the shapes are simplified by that many projected units (see
+    simplify_shapes) and cached at that level of detail.
+
+    Sets m.<name> and m.<name>_info like readshapefile does, and returns the shapes and
+    their info."""
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, cache_key(m, shapefile))
+
+    def read():
+        m.readshapefile(shapefile, name, drawbounds=False)
+        return getattr(m, name), getattr(m, name + '_info')
+
+    def simplify():
+        shapes, info = cached_shapes(path, read)
+        with instrument.span('shapes.simplify'):
+            return simplify_shapes(shapes, info, tolerance), info
+
+    with instrument.span('shapes.read'):
+        if tolerance:
+            lod_path = None if path is None else '%s-lod%r' % (path, float(tolerance))
+            shapes, info = cached_shapes(lod_path, simplify)
+        else:
+            shapes, info = cached_shapes(path, read)
+    instrument.count('shape_vertices', sum(len(shape) for shape in shapes))
+
+    setattr(m, name, shapes)
+    setattr(m, name + '_info', info)
+    if drawbounds:
+        with instrument.span('shapes.draw_bounds'):
+            ax = ax or m._check_ax()
+            lines = mcollections.LineCollection(shapes, antialiaseds=(1,))
+            lines.set_color(color)
+            lines.set_linewidth(linewidth)
+            lines.set_label('_nolabel_')
+            ax.add_collection(lines)
+            m.set_axes_limits(ax=ax)
+            # Clip the boundaries to the map limb, as readshapefile does
+            lines, c = m._cliplimb(ax, lines)
+
+    return shapes, info
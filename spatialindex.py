@@ -0,0 +1,115 @@
+"""Assigns points to the polygons containing them.
+
+Points are bucketed into a grid of cells; each polygon ring is only tested against the
+points in the cells its bounding box covers, and those are tested a band at a time
+against the ring edges spanning the band, with numpy, so there is no loop over points."""
+
+import instrument
+from util import LazyModule
+
+np = LazyModule('numpy')
+
+# Points are tested against ring edges this many at a time
+band_size = 64
+
+def points_in_ring(x, y, ring):
+    """Returns a mask of the points (x, y) inside a closed ring, by the even-odd rule."""
+
+    inside = np.zeros(len(x), dtype=bool)
+    if len(x) == 0:
+        return inside
+
+    x1, y1 = ring[:-1, 0], ring[:-1, 1]
+    x2, y2 = ring[1:, 0], ring[1:, 1]
+    edge_min, edge_max = np.minimum(y1, y2), np.maximum(y1, y2)
+
+    order = np.argsort(y, kind='stable')
+    for start in range(0, len(order), band_size):
+        band = order[start:start + band_size]
+        bx, by = x[band, None], y[band, None]
+        # Only the edges spanning the band's latitudes can cross its points' rays
+        edges = np.flatnonzero((edge_max > by[0, 0]) & (edge_min <= by[-1, 0]))
+        ex1, ey1, ex2, ey2 = x1[edges], y1[edges], x2[edges], y2[edges]
+
+        spans = (ey1 > by) != (ey2 > by)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            crossing_x = ex1 + (by - ey1) * (ex2 - ex1) / (ey2 - ey1)
+        crossings = np.count_nonzero(spans & (bx < crossing_x), axis=1)
+        inside[band] = crossings % 2 == 1
+
+    return inside
+
+class PolygonIndex(object):
+    """A set of polygons, each made of one or more closed rings (outer boundaries and
+    holes), in the same planar coordinates as the points located in them.
+
+    owners gives the polygon each ring belongs to, numbered from 0."""
+
+    def __init__(self, rings, owners, cell_size=1.0):
+        self.rings = [np.asarray(ring, dtype=np.float64).reshape(-1, 2) for ring in rings]
+        self.rings = [ring if (ring[0] == ring[-1]).all() else np.append(ring, ring[:1], axis=0)
+                      for ring in self.rings]
+        self.owners = np.asarray(owners, dtype=np.intp)
+        self.num_owners = int(self.owners.max()) + 1 if len(self.owners) else 0
+        self.cell_size = cell_size
+
+        self.bounds = np.array([(ring[:, 0].min(), ring[:, 1].min(), ring[:, 0].max(), ring[:, 1].max())
+                                for ring in self.rings]).reshape(-1, 4)
+
+    def locate(self, x, y):
+        """Returns the polygon containing each point (x, y), or -1 for points in none.
+        Points in more than one take the first."""
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        located = np.full(len(x), -1, dtype=np.intp)
+        if not len(self.rings) or not len(x):
+            return located
+
+        # Bucket the points by grid cell, in row-major order, so each row of cells a ring's
+        # bounding box covers is one slice of the sorted points
+        xmin, ymin = self.bounds[:, 0].min(), self.bounds[:, 1].min()
+        xmax, ymax = self.bounds[:, 2].max(), self.bounds[:, 3].max()
+        cols = int((xmax - xmin) // self.cell_size) + 1
+        candidates = np.flatnonzero((x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax))
+        cells = (((y[candidates] - ymin) // self.cell_size).astype(np.intp) * cols +
+                 ((x[candidates] - xmin) // self.cell_size).astype(np.intp))
+        order = np.argsort(cells, kind='stable')
+        cells, candidates = cells[order], candidates[order]
+
+        col0, row0, col1, row1 = ((self.bounds - [xmin, ymin, xmin, ymin]) //
+                                  self.cell_size).astype(np.intp).T
+
+        ring_order = np.argsort(self.owners, kind='stable')
+        owners, firsts = np.unique(self.owners[ring_order], return_index=True)
+        for owner, rings in zip(owners, np.split(ring_order, firsts[1:])):
+            # Points inside an odd number of a polygon's rings are inside the polygon
+            inside = []
+            for ring in rings:
+                rows = np.arange(row0[ring], row1[ring] + 1) * cols
+                starts = np.searchsorted(cells, rows + col0[ring])
+                ends = np.searchsorted(cells, rows + col1[ring], side='right')
+                points = np.concatenate([candidates[start:end] for start, end in zip(starts, ends)])
+                points = points[located[points] < 0]
+
+                left, bottom, right, top = self.bounds[ring]
+                px, py = x[points], y[points]
+                points = points[(px >= left) & (px <= right) & (py >= bottom) & (py <= top)]
+                inside.append(points[points_in_ring(x[points], y[points], self.rings[ring])])
+
+            if inside:
+                points, counts = np.unique(np.concatenate(inside), return_counts=True)
+                located[points[counts % 2 == 1]] = owner
+
+        instrument.count('points_located', int(np.count_nonzero(located >= 0)))
+        return located
+
+    def aggregate(self, x, y, weights=None):
+        """Returns the number of points (x, y) in each polygon, or with weights, the total
+        weight of the points in each."""
+
+        located = self.locate(x, y)
+        found = located >= 0
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)[found]
+        return np.bincount(located[found], weights, minlength=self.num_owners).astype(np.float64)
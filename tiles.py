@@ -0,0 +1,143 @@
+"""Saves maps as pyramids of XYZ tiles instead of single images.
+
+The map (its tight bounding box, extended to a square from its top left corner) is split
+into 2**z by 2**z tiles of tile_size pixels at each zoom level z, written to
+<dest>/<z>/<x>/<y>.png with y counting down from the top. Tiles entirely outside the map
+are not written. Up to block_tiles by block_tiles tiles are rendered at a time, so only
+that much of the image is ever in memory.
+
+<dest>/manifest.json lists the tiles with a hash of each. When a pyramid is saved again,
+tiles whose contents are unchanged are not rewritten, and tiles no longer produced are
+removed. Only the writes are incremental: every tile is still rendered and hashed to find
+out whether it changed, so saving again costs as much rendering as the first save."""
+
+import io
+import os
+import os.path
+import json
+import math
+import hashlib
+
+import instrument
+from util import LazyModule
+
+np = LazyModule('numpy')
+mpl = LazyModule('matplotlib')
+mtransforms = LazyModule('matplotlib.transforms')
+Image = LazyModule('PIL.Image')
+
+tile_size = 256
+min_zoom = 0
+# None for the zoom level at which the map is at least as large as it would be saved as
+# a single image
+max_zoom = None
+block_tiles = 8
+
+def is_tiles(dest):
+    """Whether dest names a tile pyramid: a directory ending in '.tiles'."""
+
+    return isinstance(dest, str) and dest.rstrip('/' + os.sep).endswith('.tiles')
+
+def load_manifest(dest):
+    try:
+        with open(os.path.join(dest, 'manifest.json'), 'r') as fobj:
+            return json.load(fobj)
+    except (OSError, ValueError):
+        return {}
+
+def write_file(filename, data, mode='wb'):
+    """Writes data to filename, replacing it atomically."""
+
+    tmp_filename = '%s.tmp%d' % (filename, os.getpid())
+    with open(tmp_filename, mode) as fobj:
+        fobj.write(data)
+    os.replace(tmp_filename, filename)
+
+def render_block(fig, bbox, dpi, width, height):
+    """Renders the part of fig inside bbox (in inches) at dpi, returning an RGBA array of
+    exactly height by width pixels."""
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format='png', dpi=dpi, bbox_inches=bbox, pad_inches=0)
+    buf.seek(0)
+    rendered = np.asarray(Image.open(buf).convert('RGBA'))
+
+    # The rendered size can be off by a pixel from rounding
+    pixels = np.zeros((height, width, 4), dtype=np.uint8)
+    rows, cols = min(height, rendered.shape[0]), min(width, rendered.shape[1])
+    pixels[:rows, :cols] = rendered[:rows, :cols]
+    return pixels
+
+def encode_png(pixels):
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format='PNG')
+    return buf.getvalue()
+
+def savefig_dpi(fig):
+    """The dpi fig is saved at as a single image."""
+
+    dpi = mpl.rcParams['savefig.dpi']
+    return fig.dpi if dpi == 'figure' else dpi
+
+def save_tiles(fig, dest):
+    """Saves fig as a tile pyramid in the directory dest, returning its manifest.
+
+    Renders every block at every zoom level, even if dest already holds the pyramid; only
+    the files of tiles that changed are written."""
+
+    bounds = fig.get_tightbbox(fig.canvas.get_renderer())
+    side = max(bounds.width, bounds.height)
+
+    last_zoom = max_zoom
+    if last_zoom is None:
+        last_zoom = max(min_zoom, int(math.ceil(math.log2(side * savefig_dpi(fig) / tile_size))))
+
+    previous = load_manifest(dest).get('tiles', {})
+    hashes = {}
+    os.makedirs(dest, exist_ok=True)
+
+    for zoom in range(min_zoom, last_zoom + 1):
+        tile_inches = side / 2 ** zoom
+        dpi = tile_size / tile_inches
+        cols = min(2 ** zoom, int(math.ceil(bounds.width / tile_inches)))
+        rows = min(2 ** zoom, int(math.ceil(bounds.height / tile_inches)))
+
+        for block_y in range(0, rows, block_tiles):
+            for block_x in range(0, cols, block_tiles):
+                nx, ny = min(block_tiles, cols - block_x), min(block_tiles, rows - block_y)
+                bbox = mtransforms.Bbox.from_extents(bounds.x0 + block_x * tile_inches,
+                                                     bounds.y1 - (block_y + ny) * tile_inches,
+                                                     bounds.x0 + (block_x + nx) * tile_inches,
+                                                     bounds.y1 - block_y * tile_inches)
+                with instrument.span('tiles.render'):
+                    pixels = render_block(fig, bbox, dpi, nx * tile_size, ny * tile_size)
+
+                with instrument.span('tiles.write'):
+                    for j in range(ny):
+                        for i in range(nx):
+                            name = '%d/%d/%d.png' % (zoom, block_x + i, block_y + j)
+                            data = encode_png(pixels[j * tile_size:(j + 1) * tile_size,
+                                                     i * tile_size:(i + 1) * tile_size])
+                            hashes[name] = hashlib.sha1(data).hexdigest()
+
+                            filename = os.path.join(dest, name)
+                            if previous.get(name) == hashes[name] and os.path.isfile(filename):
+                                instrument.count('tiles_unchanged')
+                                continue
+                            os.makedirs(os.path.dirname(filename), exist_ok=True)
+                            write_file(filename, data)
+                            instrument.count('tiles_written')
+
+    for name in set(previous) - set(hashes):
+        try:
+            os.remove(os.path.join(dest, name))
+        except OSError:
+            pass
+
+    manifest = {'tile_size': tile_size, 'min_zoom': min_zoom, 'max_zoom': last_zoom,
+                # Size of the map in pixels at max_zoom
+                'width': int(round(bounds.width / side * tile_size * 2 ** last_zoom)),
+                'height': int(round(bounds.height / side * tile_size * 2 ** last_zoom)),
+                'tiles': dict(sorted(hashes.items()))}
+    write_file(os.path.join(dest, 'manifest.json'), json.dumps(manifest, indent=1), 'w')
+    return manifest
@@ -1,6 +1,36 @@
 import re
+import importlib
 from operator import itemgetter
 
+class LazyModule(object):
+    """Stands in for a module, which is only imported when one of its attributes is first
+    used (or import_now is called). Its own attributes are underscored so as not to hide
+    the module's."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def import_now(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.import_now(), attr)
+
+    def __repr__(self):
+        return 'LazyModule(%r)' % self._name
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+
+def init():
+    """Imports numpy and pandas now rather than on first use."""
+
+    np.import_now()
+    pd.import_now()
+
 point_pattern_re = re.compile(r'~?(\d+)[°o]\s?(?:(\d+(?:\.\d+)?)\s?[\'′’]?)?\s?(?:(\d+(?:\.\d+)?)(?:["″”]|\'\')?)?\s?([NESW])')
 float_re = re.compile(r'(\d+\.\d+)\s*°?\s*([NESW])')
 comma_dot_re = re.compile(r'(\d+,\d+)')
@@ -33,6 +63,23 @@ def parse_latlon(s):
 
         return latlon
 
+def parse_latlon_array(values):
+    """Parses a whole column of latitudes or longitudes into a float64 array.
+
+    Values that are already decimal are converted in a single pass; only the
+    leftovers go through parse_latlon. Unparseable values become NaN."""
+
+    strings = pd.Series(values, dtype=object).reset_index(drop=True)
+    latlons = pd.to_numeric(strings, errors='coerce').to_numpy(dtype=np.float64, copy=True)
+
+    leftovers = np.flatnonzero(np.isnan(latlons) & strings.notna().to_numpy())
+    for i in leftovers:
+        latlon = parse_latlon(str(strings.iat[i]))
+        if latlon is not None:
+            latlons[i] = latlon
+
+    return latlons
+
 def parse_lat_and_lon(s):
     if s.count(',') > 1:
         s = comma_dot_re.subn(lambda m: m.group(1).replace(',', '.'), s)[0]
@@ -58,6 +105,16 @@ class ColorBins(object):
         self.bins = sorted(list(bins_dict.items()), key=itemgetter(0), reverse=True)
         self.default = default
 
+        # Lookup table for vectorized binning: thresholds in ascending order, with the
+        # default style at index 0 so searchsorted results index the styles directly
+        ascending = self.bins[::-1]
+        self.thresholds = np.array([binmag for binmag, style in ascending], dtype=np.float64)
+        self.styles = [default] + [style for binmag, style in ascending]
+        self.sizes = np.array([size for size, color in self.styles], dtype=np.float64)
+        self.colors = np.empty(len(self.styles), dtype=object)
+        for i, (size, color) in enumerate(self.styles):
+            self.colors[i] = color
+
     def __call__(self, magnitude):
         for binmag, style in self.bins:
             if magnitude >= binmag:
@@ -65,5 +122,21 @@ class ColorBins(object):
         else:
             return self.default
 
+    def bin_indices(self, magnitudes):
+        """Returns the index into self.styles for each of an array of magnitudes.
+
+        Index 0 is the default style, which is also used for NaN magnitudes."""
+
+        magnitudes = np.asarray(magnitudes, dtype=np.float64)
+        indices = np.searchsorted(self.thresholds, magnitudes, side='right')
+        indices[np.isnan(magnitudes)] = 0
+        return indices
+
+    def lookup(self, magnitudes):
+        """Vectorized equivalent of __call__: returns arrays of sizes and colors."""
+
+        indices = self.bin_indices(magnitudes)
+        return self.sizes[indices], self.colors[indices]
+
     def __repr__(self):
         return 'ColorBins(%r, default=%r)' % (self.bins, self.default)